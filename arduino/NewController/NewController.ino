@@ -8,14 +8,18 @@ const char
   typeAllColor = '\x01',
   typeOneColor = '\x02',
   typeAllGray  = '\x03',
+  typeEachColor = '\x04',
   lengthAllColor = '\x03',
   lengthOneColor = '\x04',
   lengthAllGray  = '\x01';
+// Number of outputs; must match FRAME_OUTPUTS of the NewController class.
+const byte outputs = 5;
 PCA9685_RGB controller = PCA9685_RGB();
 
 // Declare functions to benefit commandline compiling
 bool readByte(byte &receivedByte);
 void commandAllOutputs(void);
+void commandEachOutput(void);
 void commandGrayScale(void);
 void commandSingleOutput(void);
 
@@ -41,6 +45,9 @@ void loop(void) {
       case typeAllGray:
         commandGrayScale();
         break;
+      case typeEachColor:
+        commandEachOutput();
+        break;
       default:
         // Bad command TYPE, turn off all inputs
         controller.setAll(0);
@@ -59,7 +66,6 @@ void commandAllOutputs(void) {
 
 void commandSingleOutput(void) {
   // Sets an RGB color for a single output of the Lightbox.
-  const byte outputs = 5;
   byte receivedByte, red, green, blue, output;
   // Verify payload length, if correct, read payload and set output color.
   if (readByte(receivedByte) && receivedByte == lengthOneColor)
@@ -68,6 +74,21 @@ void commandSingleOutput(void) {
       controller.setLed(output, red, green, blue);
 }
 
+void commandEachOutput(void) {
+  // Sets an RGB color for each of the outputs of the Lightbox in one frame.
+  byte receivedByte, red[outputs], green[outputs], blue[outputs];
+  // Verify payload length, if correct, read all colors before setting any.
+  if (!readByte(receivedByte) || receivedByte % 3 || receivedByte / 3 > outputs)
+    return;
+  byte count = receivedByte / 3;
+  for (byte output = 0; output < count; ++output)
+    if (!(readByte(red[output]) && readByte(green[output]) &&
+          readByte(blue[output])))
+      return;
+  for (byte output = 0; output < count; ++output)
+    controller.setLed(output, red[output], green[output], blue[output]);
+}
+
 void commandGrayScale(void) {
   // Sets a grayscale level for all outputs on the Lightbox.
   byte receivedByte, level;
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+"""Lightbox binary command protocol, over UDP or a Unix datagram socket
+
+This module contains a compact command interface for clients that update
+layers at a high rate, such as audio-reactive or sensor-driven ones. Each
+datagram holds a header and any number of fixed-size commands:
+
+  Header (7 bytes):
+    The magic bytes 'LB', the protocol version (1) and a sequence number (an
+    unsigned 32-bit integer, big-endian).
+  Command (9 bytes each):
+    The action (1 for Constant, 2 for Fade), the output and layer numbers, the
+    red, green and blue channels, the opacity (0-255 for 0.0 to 1.0) and the
+    duration of the fade in milliseconds (an unsigned 16-bit integer,
+    big-endian; ignored for Constant).
+
+Datagrams with a sequence number that is not newer than the last one received
+from the same sender are stale, and dropped. A sequence number of 0 is always
+accepted, so a restarted client may start counting from 0 again.
+
+Commands replace the transitions of their layer, and of all commands for the
+same layer received before the controller's next tick, only the latest is
+performed. Stale commands are thus dropped rather than queued.
+"""
+__author__ = 'Elmer de Looff <elmer@underdark.nl>'
+__version__ = '1.0'
+
+# Standard modules
+import SocketServer
+import struct
+
+HEADER = struct.Struct('!2sBI')
+COMMAND = struct.Struct('!BBBBBBBH')
+MAGIC = 'LB'
+VERSION = 1
+ACTIONS = {1: 'Constant',
+           2: 'Fade'}
+
+
+class BinaryHandler(SocketServer.BaseRequestHandler):
+  """Handles a single datagram of binary commands."""
+  def handle(self):
+    """Parses the datagram and posts its commands to the controller."""
+    data, _socket = self.request
+    server = self.server
+    if len(data) < HEADER.size or (len(data) - HEADER.size) % COMMAND.size:
+      server.invalid += 1
+      return
+    magic, version, sequence = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+      server.invalid += 1
+      return
+    if not server.Fresh(self.client_address, sequence):
+      server.stale += 1
+      return
+    for offset in range(HEADER.size, len(data), COMMAND.size):
+      try:
+        server.PostCommand(*COMMAND.unpack_from(data, offset))
+      except (IndexError, KeyError):
+        server.invalid += 1
+
+
+class BinaryServerMixIn:
+  """Tracks sequence numbers per sender, and posts commands to the controller.
+
+  Counts of `invalid` datagrams and commands, and of `stale` datagrams, are
+  kept for inspection.
+  """
+  def InitBinary(self, box):
+    """Sets up the server state for the given Lightbox controller."""
+    self.box = box
+    self.invalid = 0
+    self.sequences = {}
+    self.stale = 0
+
+  def Fresh(self, sender, sequence):
+    """Returns whether the sequence number is newer than the last one seen."""
+    last = self.sequences.get(sender)
+    if sequence and last is not None:
+      # Serial number arithmetic, so the sequence may wrap around.
+      if not 0 < (sequence - last) % 2**32 < 2**31:
+        return False
+    self.sequences[sender] = sequence
+    return True
+
+  def PostCommand(self, action, output, layer, red, green, blue, opacity,
+                  duration):
+    """Posts a single command to the controller, replacing any not yet done.
+
+    Unknown actions raise KeyError, unknown outputs or layers raise IndexError.
+    """
+    action = ACTIONS[action]
+    if layer >= len(self.box.snapshot[output].layers):
+      raise IndexError('Layer index out of range.')
+    options = {'color': (red, green, blue),
+               'opacity': opacity / 255.0,
+               'queue': False}
+    if action == 'Fade':
+      if duration:
+        options['duration'] = duration
+      else:
+        options['steps'] = 1
+    self.box.PostLatest(output, layer, action, options)
+
+
+class UdpBinaryServer(BinaryServerMixIn, SocketServer.UDPServer):
+  """Binary command server on a UDP port."""
+
+
+class UnixBinaryServer(BinaryServerMixIn, SocketServer.UnixDatagramServer):
+  """Binary command server on a Unix datagram socket."""
+
+
+def BinaryServer(box, address):
+  """Starts and runs a binary command server for the given controller.
+
+  The address is either a (host, port) pair for UDP, or the path of a Unix
+  datagram socket to create.
+  """
+  if isinstance(address, basestring):
+    server = UnixBinaryServer(address, BinaryHandler)
+  else:
+    server = UdpBinaryServer(address, BinaryHandler)
+  server.InitBinary(box)
+  server.serve_forever()
+
+
+def PackCommands(sequence, commands):
+  """Returns a datagram with the given sequence number and commands.
+
+  Each command is a tuple of action name ('Constant' or 'Fade'), output, layer,
+  an RGB color tuple, opacity (0.0 to 1.0) and duration in milliseconds.
+  """
+  codes = dict((name, code) for code, name in ACTIONS.iteritems())
+  parts = [HEADER.pack(MAGIC, VERSION, sequence)]
+  for action, output, layer, color, opacity, duration in commands:
+    parts.append(COMMAND.pack(codes[action], output, layer, *(
+        tuple(color) + (int(round(opacity * 255)), duration))))
+  return ''.join(parts)
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+"""Lightbox color space conversion engine
+
+This module converts colors between sRGB (0-255 per channel) and CIELAB, using
+the D65 reference white. The default backend is implemented with numpy and
+converts a single color or a whole array of colors (any shape with a trailing
+axis of three channels) in one call.
+
+The numpy backend uses the same matrices and constants as colormath, and its
+results agree with colormath's conversions to within `TOLERANCE` for each
+component. The colormath backend is retained as a (slow) reference, and is
+only available when colormath is installed.
+"""
+__author__ = 'Elmer de Looff <elmer@underdark.nl>'
+__version__ = '1.0'
+
+# Third-party modules
+import numpy
+
+try:
+  from colormath import color_objects
+  from colormath.color_conversions import convert_color
+except ImportError:
+  color_objects = None
+
+# Maximum absolute difference per component (Lab or 0-255 RGB) between the
+# results of the numpy and colormath backends.
+TOLERANCE = 1e-6
+
+# sRGB working space matrices and D65 reference white, as used by colormath.
+RGB_TO_XYZ = numpy.array([[0.412424, 0.357579, 0.180464],
+                          [0.212656, 0.715158, 0.0721856],
+                          [0.0193324, 0.119193, 0.950444]])
+XYZ_TO_RGB = numpy.array([[3.24071, -1.53726, -0.498571],
+                          [-0.969258, 1.87599, 0.0415557],
+                          [0.0556352, -0.203996, 1.05707]])
+WHITE_D65 = numpy.array([0.95047, 1.0, 1.08883])
+
+# CIE constants for the linear segment of the Lab transfer function.
+CIE_E = 216.0 / 24389.0
+CIE_SLOPE = 7.787
+CIE_OFFSET = 16.0 / 116.0
+
+
+class NumpyBackend(object):
+  """Vectorized sRGB <-> CIELAB conversions using numpy."""
+  @staticmethod
+  def RgbToLab(rgb):
+    """Returns an array of Lab colors for the given array of RGB colors."""
+    channels = numpy.asarray(rgb, dtype=float) / 255
+    linear = numpy.where(channels <= 0.04045,
+                         channels / 12.92,
+                         ((channels + 0.055) / 1.055) ** 2.4)
+    xyz = numpy.dot(linear, RGB_TO_XYZ.T) / WHITE_D65
+    xyz = numpy.where(xyz > CIE_E,
+                      numpy.cbrt(xyz),
+                      CIE_SLOPE * xyz + CIE_OFFSET)
+    lab = numpy.empty_like(xyz)
+    lab[..., 0] = 116 * xyz[..., 1] - 16
+    lab[..., 1] = 500 * (xyz[..., 0] - xyz[..., 1])
+    lab[..., 2] = 200 * (xyz[..., 1] - xyz[..., 2])
+    return lab
+
+  @staticmethod
+  def LabToRgb(lab):
+    """Returns an array of RGB colors for the given array of Lab colors.
+
+    Colors outside of the sRGB gamut are clipped to the 0-255 range.
+    """
+    return LinearToRgb(LabToLinear(lab))
+
+
+class ColormathBackend(object):
+  """Reference sRGB <-> CIELAB conversions using colormath color objects.
+
+  This converts colors one at a time, and is many times slower than the numpy
+  backend. It is provided to verify the results of the numpy backend.
+  """
+  @staticmethod
+  def RgbToLab(rgb):
+    """Returns an array of Lab colors for the given array of RGB colors."""
+    rgb = numpy.asarray(rgb, dtype=float)
+    lab = numpy.empty_like(rgb)
+    for index in numpy.ndindex(rgb.shape[:-1]):
+      color = color_objects.sRGBColor(*rgb[index], is_upscaled=True)
+      lab[index] = convert_color(
+          color, color_objects.LabColor).get_value_tuple()
+    return lab
+
+  @staticmethod
+  def LabToRgb(lab):
+    """Returns an array of RGB colors for the given array of Lab colors."""
+    lab = numpy.asarray(lab, dtype=float)
+    rgb = numpy.empty_like(lab)
+    for index in numpy.ndindex(lab.shape[:-1]):
+      color = color_objects.LabColor(*lab[index], illuminant='d65')
+      rgb[index] = convert_color(
+          color, color_objects.sRGBColor).get_value_tuple()
+    return numpy.clip(rgb * 255, 0, 255)
+
+
+class LutBackend(object):
+  """Lab -> RGB conversions from a 3D lookup table with trilinear interpolation.
+
+  The table samples the Lab space (L* 0 to 100, a* and b* -128 to 128) on a
+  regular grid of `resolution` points per axis. It holds linear RGB values,
+  which vary smoothly over Lab space and interpolate well; the sRGB transfer
+  function is applied after interpolation. The table is built on first use, and
+  if a `path` is given, it is saved there and memory-mapped on later runs. When
+  the table cannot be stored, it is reported and the table is kept in memory.
+
+  As output is 8-bit, exactness beyond that is wasted effort. At the default
+  resolution the error stays below one level; `MaxError` reports the error for
+  the chosen resolution.
+
+  RGB -> Lab conversions are not served from the table, but computed exactly.
+  """
+  LAB_LOW = numpy.array([0.0, -128.0, -128.0])
+  LAB_HIGH = numpy.array([100.0, 128.0, 128.0])
+  RESOLUTION = 65
+  TRANSFER_POINTS = 4096
+  CORNERS = numpy.array([[l, a, b] for l in (0, 1)
+                         for a in (0, 1) for b in (0, 1)])
+
+  def __init__(self, resolution=RESOLUTION, path=None):
+    if resolution < 2:
+      raise ValueError('LUT resolution must be at least 2.')
+    self.resolution = resolution
+    self.path = path
+    self.scale = (resolution - 1) / (self.LAB_HIGH - self.LAB_LOW)
+    self._max_error = None
+    self._table = None
+    self._transfer_in = numpy.linspace(0, 1, self.TRANSFER_POINTS + 1)
+    self._transfer_out = LinearToRgb(self._transfer_in)
+
+  @property
+  def table(self):
+    """Returns the lookup table, loading or building it if necessary."""
+    if self._table is None:
+      self._table = self._LoadTable()
+    return self._table
+
+  def _BuildTable(self):
+    """Returns a new table of linear RGB values for the Lab grid."""
+    axes = [numpy.linspace(low, high, self.resolution)
+            for low, high in zip(self.LAB_LOW, self.LAB_HIGH)]
+    grid = numpy.stack(numpy.meshgrid(*axes, indexing='ij'), axis=-1)
+    return LabToLinear(grid).astype(numpy.float32)
+
+  def _LoadTable(self):
+    """Returns the table from `path` if present and matching, or builds it."""
+    shape = (self.resolution,) * 3 + (3,)
+    if self.path is not None:
+      try:
+        table = numpy.load(self.path, mmap_mode='r')
+        if table.shape == shape:
+          return table
+      except (IOError, ValueError):
+        pass
+    table = self._BuildTable()
+    if self.path is not None:
+      try:
+        # Saving to a file object stops numpy from appending '.npy' to the path.
+        with open(self.path, 'wb') as lut_file:
+          numpy.save(lut_file, table)
+        return numpy.load(self.path, mmap_mode='r')
+      except (IOError, OSError, ValueError) as error:
+        print 'Could not store lookup table at %r: %s' % (self.path, error)
+    return table
+
+  def MaxError(self, samples=20000):
+    """Returns the maximum error of the table against the exact conversion.
+
+    The error is the largest absolute difference of any channel (on the 0-255
+    scale) for a fixed set of random colors within the sRGB gamut.
+    """
+    if self._max_error is None:
+      rgb = numpy.random.RandomState(0).randint(0, 256, (samples, 3))
+      error = self.LabToRgb(NumpyBackend.RgbToLab(rgb)) - rgb
+      self._max_error = float(numpy.abs(error).max())
+    return self._max_error
+
+  @staticmethod
+  def RgbToLab(rgb):
+    """Returns an array of Lab colors for the given array of RGB colors."""
+    return NumpyBackend.RgbToLab(rgb)
+
+  def LabToRgb(self, lab):
+    """Returns an array of RGB colors for the given array of Lab colors.
+
+    Colors outside of the table's Lab range are clipped to its edges, colors
+    outside of the sRGB gamut are clipped to the 0-255 range.
+    """
+    table = self.table
+    position = (numpy.asarray(lab, dtype=float) - self.LAB_LOW) * self.scale
+    position = numpy.clip(position, 0, self.resolution - 1)
+    index = numpy.minimum(position.astype(int), self.resolution - 2)
+    frac = position - index
+    # Gather the eight surrounding grid points and weigh them by proximity.
+    corners = index[..., numpy.newaxis, :] + self.CORNERS
+    weights = numpy.where(self.CORNERS, frac[..., numpy.newaxis, :],
+                          1 - frac[..., numpy.newaxis, :]).prod(axis=-1)
+    values = table[corners[..., 0], corners[..., 1], corners[..., 2]]
+    linear = (values * weights[..., numpy.newaxis]).sum(axis=-2)
+    return numpy.interp(linear, self._transfer_in, self._transfer_out)
+
+
+def Backends():
+  """Returns a dictionary of the available conversion backends by name."""
+  backends = {'lut': LutBackend, 'numpy': NumpyBackend}
+  if color_objects is not None:
+    backends['colormath'] = ColormathBackend
+  return backends
+
+
+def LabToLinear(lab):
+  """Returns an array of linear (unclipped) sRGB values for the Lab colors."""
+  lab = numpy.asarray(lab, dtype=float)
+  xyz = numpy.empty_like(lab)
+  xyz[..., 1] = (lab[..., 0] + 16) / 116
+  xyz[..., 0] = lab[..., 1] / 500 + xyz[..., 1]
+  xyz[..., 2] = xyz[..., 1] - lab[..., 2] / 200
+  cubed = xyz ** 3
+  xyz = numpy.where(cubed > CIE_E, cubed, (xyz - CIE_OFFSET) / CIE_SLOPE)
+  return numpy.dot(xyz * WHITE_D65, XYZ_TO_RGB.T)
+
+
+def LinearToRgb(linear):
+  """Returns 0-255 sRGB values for the linear sRGB values, clipped to gamut."""
+  # Negative linear values are below the gamut; clip before the power law.
+  linear = numpy.maximum(linear, 0)
+  channels = numpy.where(linear <= 0.0031308,
+                         linear * 12.92,
+                         1.055 * linear ** (1 / 2.4) - 0.055)
+  return numpy.clip(channels * 255, 0, 255)
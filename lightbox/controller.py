@@ -7,16 +7,25 @@ __author__ = 'Elmer de Looff <elmer@underdark.nl>'
 __version__ = '2.0'
 
 # Standard modules
+import collections
+import contextlib
+import glob
+import heapq
+import os
+import Queue
 import random
 import serial
+import simplejson
 import threading
 import time
 
 # Application modules
 from . import light
+from . import metrics
 from . import utils
 
 BLACK = 0, 0, 0
+DEVICE_PATTERNS = '/dev/ttyUSB*', '/dev/ttyACM*'
 
 
 class ConnectionError(Exception):
@@ -25,25 +34,73 @@ class ConnectionError(Exception):
 
 class BaseController(list):
   """Base class for a Lightbox controller."""
+  BUFFER = 4
+  FRAMES = False
+  FRAME_OUTPUTS = None
+  FRAME_SUPPORT = False
   FREQUENCY = 100
   GAMMA = 1
+  HEARTBEAT_DELAY = None
   LAYERS = 3
   OUTPUTS = 5
 
   def __init__(self, conn_info, **kwds):
-    """Initializes the BaseController for Lightbox."""
+    """Initializes the BaseController for Lightbox.
+
+    If the controller supports setting all outputs in a single command (its
+    `FRAME_SUPPORT`), the Metronome can write a whole frame per tick. This is
+    enabled by passing `frames=True`, and requires firmware that supports it;
+    other controllers ignore the option. Firmware that only
+    accepts frames of up to `frame_outputs` outputs (default `FRAME_OUTPUTS`)
+    is sent per-output commands while the controller has more outputs.
+
+    Frames are rendered by the Metronome up to `buffer` frames (default
+    `BUFFER`) ahead of the Writer that sends them to the device. The writer is
+    an instance of `writer_cls`, which defaults to the Writer.
+
+    An already opened `connection` to the device may be provided, in which case
+    `conn_info` is not used to connect.
+
+    The scheduling of output updates is performed by an instance of
+    `metronome_cls`, which defaults to the Metronome. After each tick, this
+    publishes the state of all outputs as an immutable `snapshot`. Ticks are
+    scheduled by `clock`, a function that returns the time in seconds, which
+    defaults to `utils.MonotonicTime`.
+    """
     super(BaseController, self).__init__()
+    self.clock = kwds.get('clock', utils.MonotonicTime)
+    self.frames = kwds.get('frames', self.FRAMES)
+    if self.frames and not self.FRAME_SUPPORT:
+      print '%s does not support frames, using single output commands' % (
+          type(self).__name__)
+      self.frames = False
+    self.frame_mode = False
+    self.frame_outputs = kwds.get('frame_outputs', self.FRAME_OUTPUTS)
     self.gamma_table = utils.GammaCorrectionList(kwds.get('gamma', self.GAMMA))
+    self.gamma_bytes = ''.join(
+        chr(min(level, 255)) for level in self.gamma_table)
+    self.inbox = collections.deque()
     self.last_output_id = -1
+    self.latest = {}
+    self.latest_lock = threading.Lock()
     self.layers = kwds.get('layers', self.LAYERS)
     self.lock = threading.Lock()
+    self.metrics = metrics.Metrics()
     self.output_cls = kwds.get('output_cls', light.Output)
-    self.connection = self._Connect(conn_info)
+    if 'connection' in kwds:
+      self.connection = kwds['connection']
+    else:
+      self.connection = self._Connect(conn_info)
+    self.detector = None
     self._frequency = kwds.get('frequency', self.FREQUENCY)
     self._period = 1
-    self.metronome = Metronome(self)
     for _num in range(kwds.get('outputs', self.OUTPUTS)):
       self.Add()
+    self.snapshot = tuple(output.Snapshot() for output in self)
+    self.writer = kwds.get('writer_cls', Writer)(
+        self, kwds.get('buffer', self.BUFFER))
+    self.metronome = kwds.get('metronome_cls', Metronome)(
+        self, policy=kwds.get('late_policy'))
 
   # ############################################################################
   # Info methods, some to be overridden for differing devices.
@@ -55,12 +112,17 @@ class BaseController(list):
             'device': self._DeviceInfo(),
             'commandRate': {
                 'combined': self.frequency,
-                'perOutput': float(self.frequency) / len(self)},
+                'perOutput': 1 / self.period},
+            'frameMode': self.frame_mode,
+            'conversionCache': utils.CacheStats(),
+            'envelopeCache': utils.ENVELOPE_CACHE.Stats(),
             'layerBlenders': filter(public_methods, dir(utils.Blenders)),
             'layerCount': self.layers,
+            'metronome': self.metronome.Info(),
             'outputActions': filter(public_methods, dir(light.ActionsMixIn)),
             'outputCount': len(self),
-            'transitionEnvelopes': filter(public_methods, dir(utils.Envelopes))}
+            'transitionEnvelopes': filter(public_methods, dir(utils.Envelopes)),
+            'writer': self.writer.Info()}
 
   def _DeviceInfo(self):
     """Returns a batch of hardware-specific info."""
@@ -72,15 +134,103 @@ class BaseController(list):
   # Connecting to attached hardware, also a convencience 'attempt to connect'
   #
   @classmethod
-  def FirstDevice(cls, outputs=5):
-    """Attempts to connect to first 10 USB serial devices."""
-    for usb_index in range(10):
-      conn_info = {'device': '/dev/ttyUSB%d' % usb_index}
+  def FirstDevice(cls, outputs=5, patterns=DEVICE_PATTERNS, cache=None, **kwds):
+    """Connects to the first suitable device among the serial devices present.
+
+    Candidate ports are the device names matching the glob `patterns`, which
+    are probed concurrently. The device that confirms its connection first is
+    used; connections to other suitable devices are closed again.
+
+    If a `cache` path is given, the port, controller type and frequency of the
+    connected device are stored there. On later calls, the cached port is tried
+    first, with the cached frequency, before probing all candidates. If the
+    frequency is detected in the background, it is stored once detected.
+
+    Further keyword arguments are passed on to the controller. A `frequency`
+    given this way takes precedence over the cached one.
+    """
+    cached = ReadDeviceCache(cache)
+    if cached.get('controller') == cls.__name__:
+      conn_info = {'device': cached['device']}
+      options = dict(kwds)
+      options.setdefault('frequency', cached['frequency'])
       try:
-        return cls(conn_info, outputs=outputs)
+        return cls(conn_info, outputs=outputs, **options)
       except ConnectionError:
         pass
-    raise ConnectionError('No suitable device found :(')
+    found = cls._Probe(CandidatePorts(patterns))
+    if not found:
+      raise ConnectionError('No suitable device found :(')
+    conn_info, connection = found[0]
+    box = cls(conn_info, outputs=outputs, connection=connection, **kwds)
+    if box.detector is None:
+      WriteDeviceCache(cache, box, conn_info)
+    elif cache is not None:
+      cacher = threading.Thread(
+          target=_CacheAfterDetection, args=(cache, box, conn_info))
+      cacher.daemon = True
+      cacher.start()
+    return box
+
+  @classmethod
+  def FirstDevices(cls, count, outputs=5, patterns=DEVICE_PATTERNS, **kwds):
+    """Connects to the first `count` suitable devices found, and returns them.
+
+    Candidate ports are probed as for `FirstDevice`. The controllers are ordered
+    by their port name, in the order of `patterns`. If fewer than `count`
+    devices are found, their connections are closed and ConnectionError is
+    raised.
+    """
+    ports = CandidatePorts(patterns)
+    found = cls._Probe(ports, wanted=count)
+    if len(found) < count:
+      for _conn_info, connection in found:
+        connection.close()
+      raise ConnectionError('Found %d of %d required devices.' % (
+          len(found), count))
+    found.sort(key=lambda result: ports.index(result[0]['device']))
+    return [cls(conn_info, outputs=outputs, connection=connection, **kwds)
+            for conn_info, connection in found]
+
+  @classmethod
+  def _Probe(cls, ports, wanted=1):
+    """Connects to the given ports concurrently, to find suitable devices.
+
+    Returns a list of up to `wanted` (conn_info, connection) pairs, in the order
+    the devices confirmed their connection. This returns as soon as the wanted
+    number of devices is found; connections that are confirmed after that are
+    closed again.
+    """
+    results = Queue.Queue()
+    def _Attempt(port):
+      conn_info = {'device': port}
+      try:
+        results.put((conn_info, cls._Connect(conn_info)))
+      except Exception:  # Every attempt must put a result, or get() blocks.
+        results.put(None)
+
+    def _CloseRemaining(count):
+      for _port in range(count):
+        result = results.get()
+        if result is not None:
+          result[1].close()
+
+    for port in ports:
+      thread = threading.Thread(target=_Attempt, args=(port,))
+      thread.daemon = True
+      thread.start()
+    found = []
+    for remaining in range(len(ports), 0, -1):
+      result = results.get()
+      if result is not None:
+        found.append(result)
+        if len(found) == wanted:
+          closer = threading.Thread(
+              target=_CloseRemaining, args=(remaining - 1,))
+          closer.daemon = True
+          closer.start()
+          break
+    return found
 
   @staticmethod
   def _Connect(conn_info):
@@ -143,16 +293,58 @@ class BaseController(list):
   def _UpdateOutputFrequency(self):
     """Calculates the new per output command frequency.
 
-    Also sets the period time for the Metronome.
+    Also sets the period time for the Metronome. In frame mode, every command
+    updates all outputs, so each output is updated at the controller frequency.
+    Frame mode is only used while the number of outputs fits in a frame.
     """
+    self.frame_mode = self.frames and (
+        self.frame_outputs is None or len(self) <= self.frame_outputs)
+    if self.frames and not self.frame_mode:
+      print 'Frames hold at most %d outputs, using single output commands' % (
+          self.frame_outputs)
     if self:
-      per_output_hz = float(self._frequency) / len(self)
+      per_output_hz = float(self._frequency)
+      if not self.frame_mode:
+        per_output_hz /= len(self)
       self._period = 1.0 / per_output_hz
       print 'Individual output frequency now %.1fHz' % per_output_hz
     else:
       print 'No outputs defined'
       self._period = 0.1
 
+  # ############################################################################
+  # Actions performed by the Metronome, between ticks
+  #
+  def Post(self, output_id, action, options):
+    """Posts an action for the numbered output, to be performed between ticks.
+
+    The action is the name of one of the output's methods, which is called with
+    the `options` as keyword arguments by the Metronome before its next tick.
+    This way, outputs and layers are only changed by the rendering thread.
+    """
+    self.inbox.append([(self[output_id], action, options)])
+
+  def PostBatch(self, commands):
+    """Posts a list of actions, to be performed between the same two ticks.
+
+    Each command is an (output_id, action, options) tuple, as for `Post`. All
+    output numbers are checked before anything is posted; an unknown output
+    raises IndexError.
+    """
+    self.inbox.append([(self[output_id], action, options)
+                       for output_id, action, options in commands])
+
+  def PostLatest(self, output_id, layer, action, options):
+    """Posts an action for a layer, replacing any not yet performed for it.
+
+    This is meant for clients that send the state of a layer at a high rate:
+    only the latest action for each layer is performed before the next tick,
+    after those posted with `Post`. The `layer` is passed to the action.
+    """
+    output = self[output_id]
+    with self.latest_lock:
+      self.latest[output, layer] = action, options
+
   # ############################################################################
   # Output cycling
   #
@@ -176,18 +368,58 @@ class BaseController(list):
   #
   def Command(self, command):
     """Send the command to the serial device and wait for the confirmation."""
-    with self.lock:
-      self._Command(command)
+    with self._Locked():
+      self._Write(command)
       self._Verify()
 
+  def Commands(self, commands):
+    """Sends the commands to the serial device in a single write.
+
+    After writing, the confirmations for each of the commands are awaited.
+    """
+    with self._Locked():
+      self._Write(''.join(commands))
+      for _command in commands:
+        self._Verify()
+
   def SetAll(self, color):
     """Sets the color for all outputs."""
-    self.Command(self._CommandSetAll(*[self.gamma_table[i] for i in color]))
+    self.Command(self._CommandSetAll(*self._GammaCorrect(color)))
+
+  def SetFrame(self, colors):
+    """Sets the colors for all outputs, in order, using a single command."""
+    self.Command(self._CommandSetFrame(*self._GammaCorrect(
+        channel for color in colors for channel in color)))
+
+  def SetMultiple(self, colors):
+    """Sets the colors for a number of outputs, given as (output, color) pairs.
+
+    The commands for all outputs are written to the device at once.
+    """
+    self.Commands([self._CommandSetSingle(output, *self._GammaCorrect(color))
+                   for output, color in colors])
 
   def SetSingle(self, output, color):
     """Sets the color for a single numbered output."""
-    self.Command(self._CommandSetSingle(
-        output, *[self.gamma_table[i] for i in color]))
+    self.Command(self._CommandSetSingle(output, *self._GammaCorrect(color)))
+
+  def _GammaCorrect(self, channels):
+    """Returns the gamma corrected channel levels, using a translation table."""
+    return bytearray(str(bytearray(channels)).translate(self.gamma_bytes))
+
+  @contextlib.contextmanager
+  def _Locked(self):
+    """Holds the controller lock, recording the time spent waiting for it."""
+    start = utils.MonotonicTime()
+    with self.lock:
+      self.metrics.lock_wait.Observe(utils.MonotonicTime() - start)
+      yield
+
+  def _Write(self, command):
+    """Sends the command to the device, recording the time spent writing."""
+    start = utils.MonotonicTime()
+    self._Command(command)
+    self.metrics.write_time.Observe(utils.MonotonicTime() - start)
 
   # ############################################################################
   # Methods to be implemented or overridden by subclasses
@@ -203,72 +435,432 @@ class BaseController(list):
     """Returns the command that sets all outputs to the same color."""
     raise NotImplementedError
 
+  def _CommandSetFrame(self, *channels):
+    """Returns the command that sets the colors of all outputs at once."""
+    raise NotImplementedError
+
   def _CommandSetSingle(self, output, red, green, blue):
     """Returns the command that sets a single output to a given color."""
     raise NotImplementedError
 
+  def _Heartbeat(self):
+    """Sends a keepalive signal, for devices with a `HEARTBEAT_DELAY`."""
+
   def _Verify(self):
     """Verifies the repsonse received from the hardware is correct."""
     # Controllers that do verification of commands should implement this.
 
 
-class Heartbeat(threading.Thread):
-  """Heartbeat keepalive thread to keep the Lightbox controller online."""
-  def __init__(self, callback, delay=5, fail_delay=1):
-    super(Heartbeat, self).__init__(name=type(self).__name__)
-    self.beat = True
-    self.callback = callback
-    self.delay = delay
-    self.fail_delay = fail_delay
+class AckReader(threading.Thread):
+  """Matches acknowledgments from the hardware to the commands in flight.
+
+  Commands are registered with `Sent` before they are written. At most `window`
+  commands are in flight at any time, registering more blocks until the oldest
+  is acknowledged. Responses are read on this thread and matched to commands in
+  the order they were sent. Incorrect or missing acknowledgments are recorded in
+  `failures` as (command, response) pairs. A command's acknowledgment is missing
+  once `timeout` seconds have passed since it was registered, which defaults to
+  the read timeout of the connection.
+  """
+  def __init__(self, connection, response, window, timeout=None):
+    super(AckReader, self).__init__(name=type(self).__name__)
+    self.connection = connection
+    self.failures = collections.deque()
+    self.pending = collections.deque()
+    self.response = response
+    self.slots = threading.Semaphore(window)
+    if timeout is None:
+      timeout = connection.timeout
+    self.timeout = timeout
+    self.window = window
     # Daemonize and run
     self.daemon = True
     self.start()
 
+  def Sent(self, command):
+    """Registers a command as sent, waiting for room in the window if needed."""
+    self.slots.acquire()
+    self.pending.append((command, utils.MonotonicTime() + self.timeout))
+
   def run(self):
-    """Main thread to send periodic keepalives."""
-    time.sleep(self.delay)
-    while self.beat:
+    """Reads responses and matches them to the oldest pending command."""
+    while True:
       try:
-        self.callback()
-        time.sleep(self.delay)
-      except ConnectionError:
-        time.sleep(self.fail_delay)
+        response = self.connection.readline()
+      except serial.SerialException as error:
+        response = str(error)
+      if not response:
+        # Read timeout, only commands past their own deadline have failed.
+        now = utils.MonotonicTime()
+        while self.pending and self.pending[0][1] <= now:
+          self.failures.append((self.pending.popleft()[0], response))
+          self.slots.release()
+        continue
+      try:
+        command, _deadline = self.pending.popleft()
+      except IndexError:
+        self.failures.append((None, response))
+        continue
+      if response != self.response:
+        self.failures.append((command, response))
+      self.slots.release()
+
+
+class FrameBuffer(object):
+  """A ring buffer of rendered frames, passed from the Metronome to the Writer.
+
+  Each frame is a dictionary of colors by output index. When the buffer is full,
+  a new frame is merged into the newest buffered one instead of waiting for the
+  writer: the colors of outputs present in both are replaced by the newer ones.
+  No change is lost this way, but intermediate colors are.
+
+  Putting an empty frame stores nothing, but does wake the waiting reader.
+  """
+  def __init__(self, size):
+    self.coalesced = 0
+    self.frames = collections.deque()
+    self.ready = threading.Condition(threading.Lock())
+    self.size = size
+    self.woken = False
+
+  def __len__(self):
+    return len(self.frames)
+
+  def Get(self):
+    """Returns the oldest frame, waiting until a frame is put in the buffer.
+
+    If the reader is woken by an empty frame, an empty frame is returned.
+    """
+    with self.ready:
+      while not (self.frames or self.woken):
+        self.ready.wait()
+      self.woken = False
+      if self.frames:
+        return self.frames.popleft()
+      return {}
+
+  def Put(self, frame):
+    """Adds a frame to the buffer, merging it into the newest if it is full."""
+    with self.ready:
+      if not frame:
+        pass
+      elif len(self.frames) < self.size:
+        self.frames.append(frame)
+      else:
+        self.frames[-1].update(frame)
+        self.coalesced += 1
+      self.woken = True
+      self.ready.notify()
+
+
+class Writer(threading.Thread):
+  """Writes the frames rendered by the Metronome to the hardware.
+
+  Frames are taken from a FrameBuffer filled by the Metronome, so that slow
+  serial writes and verification do not delay the computation of later frames.
+  Controllers that require a periodic keepalive have it sent by the writer too,
+  every `HEARTBEAT_DELAY` seconds, between frames.
+
+  Any error while writing, such as a ConnectionError, is counted and printed,
+  and the writer continues with the next frame.
+  """
+  def __init__(self, controller, size):
+    super(Writer, self).__init__(name=type(self).__name__)
+    self.buffer = FrameBuffer(size)
+    self.controller = controller
+    self.errors = 0
+    self.heartbeat_delay = controller.HEARTBEAT_DELAY
+    self.next_heartbeat = utils.MonotonicTime() + (self.heartbeat_delay or 0)
+    # Daemonize and run
+    self.daemon = True
+    self.start()
+
+  def Info(self):
+    """Returns a dictionary with the state of the frame buffer and errors."""
+    return {'bufferSize': self.buffer.size,
+            'bufferedFrames': len(self.buffer),
+            'coalescedFrames': self.buffer.coalesced,
+            'writeErrors': self.errors}
+
+  def Put(self, frame):
+    """Queues a frame of colors by output index for writing."""
+    self.buffer.Put(frame)
+
+  def run(self):
+    """Writes frames from the buffer and heartbeats when they are due."""
+    while True:
+      frame = self.buffer.Get()
+      try:
+        if frame:
+          self._WriteFrame(frame)
+        now = utils.MonotonicTime()
+        if self.heartbeat_delay and now >= self.next_heartbeat:
+          self.next_heartbeat = now + self.heartbeat_delay
+          self.controller._Heartbeat()
+      except Exception as error:  # A failed write must not stop the Writer.
+        self.errors += 1
+        print 'Writing to the device failed: %s' % error
+
+  def _WriteFrame(self, frame):
+    """Writes the frame to the controller using the applicable command(s).
+
+    In frame mode, the frame holds the colors of all outputs, which are sent in
+    a single command. Otherwise a command is sent for each output in the frame.
+    """
+    colors = sorted(frame.items())
+    if self.controller.frame_mode:
+      self.controller.SetFrame([color for _output, color in colors])
+    else:
+      self.controller.SetMultiple(colors)
 
 
 class Metronome(threading.Thread):
-  """Sends color commands to the hardware for output objects on the controller.
+  """Renders the colors of the outputs on the controller, one frame per tick.
 
   This ensures that all outputs are written briefly after eachother, without
   interleaving of commands that would happen if each output were to generate
-  their own commands for the serial controller.
+  their own commands for the serial controller. Rendered frames are passed to
+  the controller's Writer, which sends them to the hardware.
+
+  The `policy` determines how to deal with ticks that could not be performed on
+  time; it is one of CATCH_UP, DROP (the default) or STRETCH.
   """
-  def __init__(self, controller):
+  CATCH_UP = 'catchup'
+  DROP = 'drop'
+  STRETCH = 'stretch'
+
+  def __init__(self, controller, policy=None):
     """Initializes the Metronome object."""
     super(Metronome, self).__init__(name=type(self).__name__)
+    self.clock = controller.clock
     self.controller = controller
+    self.policy = policy or self.DROP
+    if self.policy not in (self.CATCH_UP, self.DROP, self.STRETCH):
+      raise ValueError('Unknown late tick policy %r.' % self.policy)
+    self.dropped_frames = 0
+    self.late_ticks = 0
+    self.max_lateness = 0
     # Daemonize and run
     self.daemon = True
     self.start()
 
+  def Info(self):
+    """Returns a dictionary with the scheduling policy and lateness counters."""
+    return {'droppedFrames': self.dropped_frames,
+            'lateTicks': self.late_ticks,
+            'latePolicy': self.policy,
+            'maxLateness': self.max_lateness,
+            'scheduler': type(self).__name__}
+
   def run(self):
-    """Updates outputs and sleeps the remaining time"""
+    """Performs ticks and sleeps until the deadline of the next tick.
+
+    A tick that fails is reported, and rendering continues with the next.
+    """
+    deadline = self.clock()
     while True:
-      begin_time = time.time()
-      self._UpdateOutputs()
-      self._SleepRemainder(begin_time)
+      try:
+        self.Tick()
+      except Exception as error:  # A failed tick must not stop the Metronome.
+        print 'Metronome tick failed: %s' % error
+      deadline = self._NextDeadline(deadline)
+      remainder = deadline - self.clock()
+      if remainder > 0:
+        self.controller.metrics.sleep_time.Observe(remainder)
+        time.sleep(remainder)
+
+  def Tick(self):
+    """Updates the outputs once.
+
+    Actions posted to the controller are performed before the outputs are
+    updated, and the state of the outputs is published after.
+    """
+    self._PerformPosted()
+    changed = [output.dirty for output in self.controller]
+    self._UpdateOutputs()
+    self._PublishSnapshot(changed)
+
+  def _NextDeadline(self, deadline):
+    """Returns the deadline for the next tick, applying the late tick policy.
+
+    Deadlines are scheduled one period apart on a monotonic clock, so time spent
+    updating does not accumulate as drift. When a deadline has already passed,
+    the policy determines what happens:
+
+    * CATCH_UP: the schedule is kept, ticks follow without delay until caught up
+    * DROP: the frames of missed ticks are skipped, the schedule is kept
+    * STRETCH: the schedule is restarted from the current time
+    """
+    period = self._TickPeriod()
+    deadline += period
+    lateness = self.clock() - deadline
+    if lateness <= 0:
+      return deadline
+    self.late_ticks += 1
+    self.max_lateness = max(self.max_lateness, lateness)
+    if self.policy == self.DROP:
+      missed = int(lateness / period)
+      if missed:
+        self._SkipFrames(missed)
+        deadline += missed * period
+    elif self.policy == self.STRETCH:
+      deadline += lateness
+    return deadline
+
+  def _TickPeriod(self):
+    """Returns the time between ticks, the per-output update period."""
+    return self.controller.period
+
+  def _PerformPosted(self):
+    """Performs the actions posted to the controller, in order.
+
+    The latest actions posted per layer are performed after all others.
+    """
+    controller = self.controller
+    while controller.inbox:
+      for output, action, options in controller.inbox.popleft():
+        self._Perform(output, action, options)
+    if controller.latest:
+      with controller.latest_lock:
+        latest, controller.latest = controller.latest, {}
+      for (output, layer), (action, options) in latest.iteritems():
+        self._Perform(output, action, dict(options, layer=layer))
 
-  def _SleepRemainder(self, begin_time):
-    """Sleeps for the remainder of this period."""
-    remainder = begin_time + self.controller.period - time.time()
-    if remainder > 0:
-      time.sleep(remainder)
+  @staticmethod
+  def _Perform(output, action, options):
+    """Performs a single posted action on the output."""
+    try:
+      getattr(output, action)(**options)
+    except Exception as error:  # A bad action must not stop the Metronome.
+      print 'Posted action %s failed: %s' % (action, error)
+
+  def _PublishSnapshot(self, changed):
+    """Publishes the state of all outputs as the controller's snapshot.
+
+    Only the state of outputs that were `changed` is taken anew, the state of
+    the others is reused from the previous snapshot.
+    """
+    controller = self.controller
+    previous = controller.snapshot
+    if len(previous) != len(changed):
+      changed = [True] * len(changed)
+    controller.snapshot = tuple(
+        output.Snapshot() if output_changed else state
+        for output, output_changed, state
+        in zip(controller, changed, previous))
+
+  def _SkipFrames(self, frames):
+    """Advances all changing outputs by a number of frames, without sending."""
+    self.dropped_frames += frames
+    for output in self.controller:
+      if output.dirty:
+        output.Skip(frames)
 
   def _UpdateOutputs(self):
-    """Sends color commands for all outputs that have changed."""
+    """Renders a frame with the colors of all outputs that have changed.
+
+    The colors for all outputs with changes are mixed together, as one frame.
+    In frame mode, the frame holds the colors of all outputs if any of them
+    changed, otherwise only those of the changed outputs. The frame is passed
+    to the Writer, which is woken on every tick, even without changes.
+
+    The time spent mixing, the number of outputs sent or skipped as unchanged,
+    and the queue depths of all layers are recorded in the controller metrics.
+    """
+    stats = self.controller.metrics
+    stats.ticks += 1
+    start = utils.MonotonicTime()
+    dirty = []
+    for index, output in enumerate(self.controller):
+      stats.ObserveQueues(output)
+      if output.dirty:
+        dirty.append((index, output))
+    changed = []
+    if dirty:
+      indices, outputs = zip(*dirty)
+      changed = [(index, color) for index, output, color
+                 in zip(indices, outputs, light.MixOutputs(outputs))
+                 if output.StoreColor(color)]
+    stats.compute_time.Observe(utils.MonotonicTime() - start)
+    stats.frames_sent += len(changed)
+    stats.frames_skipped += len(self.controller) - len(changed)
+    if changed and self.controller.frame_mode:
+      changed = [(index, output.color)
+                 for index, output in enumerate(self.controller)]
+    self.controller.writer.Put(dict(changed))
+
+
+class AdaptiveMetronome(Metronome):
+  """Metronome that allocates command slots to the outputs that need them most.
+
+  Rather than giving every output an equal share of the commands, this ticks at
+  the controller frequency and sends up to `SLOTS` commands per tick. The slots
+  go to the changing outputs with the greatest need, which grows with the time
+  since their last update, weighted by the size of their last color change. An
+  animating output thus gets (nearly) the full command rate while the others
+  are idle, and no changing output is starved.
+
+  Outputs that have not been sent for `KEEPALIVE` seconds are resent when they
+  are the neediest, to keep the hardware from timing out.
+
+  Transitions advance a frame with each update of their output, so transitions
+  defined in `steps` speed up as their output gets more updates. Transitions
+  with a `duration` keep their timing, and are rendered more smoothly.
+
+  In frame mode every command updates all outputs, so this sends a frame on each
+  tick, exactly like the Metronome.
+  """
+  KEEPALIVE = 0.5
+  SLOTS = 1
+
+  def __init__(self, controller, policy=None):
+    self.changes = {}
+    self.last_sent = {}
+    super(AdaptiveMetronome, self).__init__(controller, policy=policy)
+
+  def _TickPeriod(self):
+    """Returns the time between ticks, the time to send a command per slot."""
+    return self.SLOTS / float(self.controller.frequency)
+
+  def _UpdateOutputs(self):
+    """Renders the colors of the neediest outputs, and sends those.
+
+    The need of a changing output is the time since it was last sent, multiplied
+    by one plus the largest channel difference of its last change. Unchanging
+    outputs are resent only for keepalive, with a need of the time since they
+    were last sent.
+    """
+    if self.controller.frame_mode:
+      return super(AdaptiveMetronome, self)._UpdateOutputs()
+    stats = self.controller.metrics
+    stats.ticks += 1
+    start = utils.MonotonicTime()
+    now = self.clock()
+    candidates = []
     for index, output in enumerate(self.controller):
-      color = output.NewColor()
-      if color:
-        self.controller.SetSingle(index, color)
+      stats.ObserveQueues(output)
+      age = now - self.last_sent.get(index, 0)
+      if output.dirty:
+        need = age * (1 + self.changes.get(index, 0))
+        candidates.append((need, index, output))
+      elif age > self.KEEPALIVE:
+        candidates.append((age, index, output))
+    frame = {}
+    for _need, index, output in heapq.nlargest(self.SLOTS, candidates):
+      self.last_sent[index] = now
+      previous = output.color
+      if output.dirty:
+        color, = light.MixOutputs([output])
+        if not output.StoreColor(color):
+          self.changes[index] = 0
+          continue
+        self.changes[index] = max(
+            abs(new - old) for new, old in zip(color, previous))
+      frame[index] = output.color
+    stats.compute_time.Observe(utils.MonotonicTime() - start)
+    stats.frames_sent += len(frame)
+    stats.frames_skipped += len(self.controller) - len(frame)
+    self.controller.writer.Put(frame)
 
 
 # ##############################################################################
@@ -280,21 +872,35 @@ class Dummy(BaseController):
   This is useful for testing all the other parts of Lightbox when the required
   hardware is not available.
   """
+  FRAME_SUPPORT = True
+
   @classmethod
-  def FirstDevice(cls, outputs=5):
-    """Returns a functional Dummy controller."""
-    return cls(None, outputs=outputs)
+  def FirstDevice(cls, outputs=5, patterns=None, cache=None, **kwds):
+    """Returns a functional Dummy controller, with the given options."""
+    return cls(None, outputs=outputs, **kwds)
+
+  @classmethod
+  def FirstDevices(cls, count, outputs=5, patterns=None, **kwds):
+    """Returns `count` functional Dummy controllers, with the given options."""
+    return [cls(None, outputs=outputs, **kwds) for _device in range(count)]
 
   def _Command(self, _command):
     """Dummy controller doesn't perform commands."""
 
   def _CommandSetAll(self, *color):
     """Dummy controller doesn't perform commands."""
+    return ''
+
+  def _CommandSetFrame(self, *channels):
+    """Dummy controller doesn't perform commands."""
+    return ''
 
   def _CommandSetSingle(self, *args):
     """Dummy controller doesn't perform commands."""
+    return ''
 
-  def _Connect(self, conn_info):
+  @classmethod
+  def _Connect(cls, conn_info):
     """Connecting to a Dummy controller never fails to connect."""
 
   def _DeviceInfo(self):
@@ -318,17 +924,71 @@ class JTagController(BaseController):
   * Both of these commands receive a reply from the controller. The reply is a
     capital 'R' ended by a CR-LF.
   * Every five seconds (though actual timeout occurs after ten), a 'heartbeat'
-    should be sent. This consists of a capital 'H' followed by a CR-LF.
+    should be sent. This consists of a capital 'H' followed by a CR-LF. It is
+    sent by the Writer, between frames.
+
+  Commands are pipelined: up to `window` commands (default `WINDOW`) are sent
+  before their replies are received, which are matched up by an AckReader. An
+  incorrect or missing reply raises ConnectionError for the failed command on
+  the next command sent. Pass `window=1` to wait for each reply instead.
+
+  The command rate of the controller is measured for a second after connecting.
+  This is skipped if a `frequency` is given, or performed in the background if
+  `background_detect` is set, starting out at the default `FREQUENCY`.
   """
   ALL_OUTPUTS = '#%d,%d,%d\n'
   ONE_OUTPUT = '$%d,%d,%d,%d\n'
   HEARTBEAT = 'H\n'
+  HEARTBEAT_DELAY = 5
   RESPONSE = 'R\r\n'
+  WINDOW = 4
 
   def __init__(self, *args, **kwds):
+    self.acks = None
+    self.frequency_detected = False
     super(JTagController, self).__init__(*args, **kwds)
-    self.frequency = self._DetectFrequency()
-    Heartbeat(self._Heartbeat)
+    window = kwds.get('window', self.WINDOW)
+    if window > 1:
+      with self.lock:
+        self.acks = AckReader(self.connection, self.RESPONSE, window)
+    if 'frequency' in kwds:
+      pass  # Known frequency, detection is not needed.
+    elif kwds.get('background_detect'):
+      self.detector = threading.Thread(target=self._DetectFrequency)
+      self.detector.daemon = True
+      self.detector.start()
+    else:
+      self._DetectFrequency()
+
+  def Command(self, command):
+    """Sends the command to the serial device.
+
+    Without pipelining, this waits for the confirmation of the command.
+    """
+    if self.acks is None:
+      return super(JTagController, self).Command(command)
+    self.Commands([command])
+
+  def Commands(self, commands):
+    """Sends the commands to the serial device, pipelining where enabled.
+
+    With pipelining, commands are written in chunks of up to the window size,
+    and failures reported for earlier commands are raised afterwards. Without
+    it, each command is written once the previous one is confirmed.
+    """
+    with self._Locked():
+      if self.acks is None:
+        for command in commands:
+          self._Write(command)
+          self._Verify()
+        return
+      window = self.acks.window
+      for start in range(0, len(commands), window):
+        chunk = commands[start:start + window]
+        for command in chunk:
+          self.acks.Sent(command)
+        self._Write(''.join(chunk))
+      self._Verify()
 
   def _CommandSetAll(self, *colors):
     """Sets all outputs to the same color."""
@@ -338,7 +998,8 @@ class JTagController(BaseController):
     """Sets a single output to a given color."""
     return self.ONE_OUTPUT % args
 
-  def _Connect(self, conn_info):
+  @classmethod
+  def _Connect(cls, conn_info):
     """Returns a tested and confirmed serial connection to the hardware.
 
     After connecting, we attempt to send a command and verify the confirmation.
@@ -346,37 +1007,54 @@ class JTagController(BaseController):
     requirements of the connected hardware.
     """
     conn_info['baudrate'] = 57600
-    conn = super(JTagController, self)._Connect(conn_info)
-    conn.flushInput()
-    time.sleep(1.5)  # Wait for ATmega to reboot on connect
-    for _attempt in range(5):
-      conn.write(self.ALL_OUTPUTS % BLACK)
-      if conn.readline() == self.RESPONSE:
-        return conn
-    else:
-      raise ConnectionError('Device on port %s not a proper %s.' % (
-          conn_info['device'], type(self).__name__))
+    conn = super(JTagController, cls)._Connect(conn_info)
+    try:
+      conn.flushInput()
+      time.sleep(1.5)  # Wait for ATmega to reboot on connect
+      for _attempt in range(5):
+        conn.write(cls.ALL_OUTPUTS % BLACK)
+        if conn.readline() == cls.RESPONSE:
+          return conn
+    except Exception as error:  # Serial and terminal errors alike.
+      conn.close()
+      raise ConnectionError('Device on port %s failed: %s' % (
+          conn_info['device'], error))
+    conn.close()
+    raise ConnectionError('Device on port %s not a proper %s.' % (
+        conn_info['device'], cls.__name__))
 
   def _DetectFrequency(self):
-    """Returns the number of commands the controller handles in one second."""
+    """Sets the frequency to the number of commands handled in one second."""
     begin_time = time.time()
     frequency = 0
     while time.time() - begin_time < 1:
       self.SetAll(BLACK)
       frequency += 1
     print 'Controller frequency set to %dHz' % frequency
-    return frequency
+    self.frequency = frequency
+    self.frequency_detected = True
 
   def _Heartbeat(self):
     """Sends a heartbeat signal to the controller."""
-    self._Command(self.HEARTBEAT)
+    with self._Locked():
+      self._Write(self.HEARTBEAT)
 
   def _Verify(self):
-    """Verifies the proper response from the Lightbox controller hardware."""
-    response = self.connection.readline()
-    if response != self.RESPONSE:
-      raise ConnectionError('Incorrect acknowledgment: expected %r got: %r.' % (
-          self.RESPONSE, response))
+    """Verifies the proper response from the Lightbox controller hardware.
+
+    With pipelining, this raises for the first failure recorded by the
+    AckReader, without waiting for the replies to commands still in flight.
+    """
+    if self.acks is None:
+      response = self.connection.readline()
+      if response != self.RESPONSE:
+        raise ConnectionError('Incorrect acknowledgment: expected %r got: %r.'
+                              % (self.RESPONSE, response))
+    elif self.acks.failures:
+      command, response = self.acks.failures.popleft()
+      raise ConnectionError(
+          'Incorrect acknowledgment for command %r: expected %r got: %r.' % (
+              command, self.RESPONSE, response))
 
 
 class NewController(BaseController):
@@ -384,16 +1062,19 @@ class NewController(BaseController):
 
   The controller accepts commands over a 57k6 serial connection. The protocol
   for this controller is binary, as opposed to the human readable for the
-  JTagController. The controller accepts two different commands, in TLV format:
+  JTagController. The controller accepts the following commands, in TLV format:
 
   The first byte indicates the TYPE of command. The type value to set all
   outputs to a single color is `0x01`. The command to set a single output to a
-  color is `0x02`.
+  color is `0x02`. The command to set each output to its own color, in a single
+  frame, is `0x04`.
 
   Following this type value is the LENGTH of the data. To set all outputs, three
   color bytes must follow and the length value is `0x03`. For single-output
   commands, the payload is 4 bytes (output, red, green, blue) and the length
-  value comes out as `0x04`.
+  value comes out as `0x04`. For frame commands, the payload is three bytes
+  (red, green, blue) for each output, starting at the first. The length value
+  is three times the number of outputs.
 
   Output and color values are written as single bytes in the range 0-4 and 0-255
   respectively.
@@ -404,20 +1085,32 @@ class NewController(BaseController):
 
   Note that there are NO confirmations by the hardware. This maximizes
   throughput but reduces the opportunity for debugging.
+
+  Frame commands are only supported by recent firmware, so frame mode must be
+  enabled with `frames=True`. The firmware accepts frames for up to
+  `FRAME_OUTPUTS` outputs; set `frame_outputs` if it was built for more.
   """
+  FRAME_OUTPUTS = 5
+  FRAME_SUPPORT = True
   FREQUENCY = 200
   ALL_OUTPUTS = '\x01\x03%c%c%c'
   ONE_OUTPUT = '\x02\x04%c%c%c%c'
+  EACH_OUTPUT = '\x04%c%s'
 
   def _CommandSetAll(self, *colors):
     """Sets all outputs to the same color."""
     return self.ALL_OUTPUTS % colors
 
+  def _CommandSetFrame(self, *channels):
+    """Sets each of the outputs to its own color."""
+    return self.EACH_OUTPUT % (len(channels), ''.join(map(chr, channels)))
+
   def _CommandSetSingle(self, *args):
     """Sets a single output to a given color."""
     return self.ONE_OUTPUT % args
 
-  def _Connect(self, conn_info):
+  @classmethod
+  def _Connect(cls, conn_info):
     """Returns a tested and confirmed serial connection to the hardware.
 
     After connecting to the serial port, we pulse the DTR line once. This resets
@@ -426,7 +1119,7 @@ class NewController(BaseController):
     """
     conn_info['baudrate'] = 57600
     conn_info['timeout'] = 3 # We read once to confirm hardware; no perf. impact
-    conn = super(NewController, self)._Connect(conn_info)
+    conn = super(NewController, cls)._Connect(conn_info)
     try:
       # Reset the connected ATmega by pulsing DTR.
       conn.setDTR(True)
@@ -435,6 +1128,226 @@ class NewController(BaseController):
       # Some USB serial drivers do not implement DSR/DTR. This raises IOErrors
       # We'll try to continue like nothing happened, though we'll likely fail.
       pass
-    if conn.readline().strip() != '[Lightbox]':
+    try:
+      greeting = conn.readline()
+    except Exception as error:  # Serial and terminal errors alike.
+      conn.close()
+      raise ConnectionError('Device on port %s failed: %s' % (
+          conn_info['device'], error))
+    if greeting.strip() != '[Lightbox]':
+      conn.close()
       raise ConnectionError('Device is not a [Lightbox].')
     return conn
+
+
+class MultiController(BaseController):
+  """Lightbox controller that combines several devices into one.
+
+  The outputs of all devices are presented as one contiguous list, in the order
+  the devices are given. Each device keeps its own Metronome and Writer, so the
+  outputs of the devices are rendered and written in parallel, and the combined
+  command rate is the sum of that of the devices.
+
+  Commands for multiple outputs are split up and sent to the devices that the
+  outputs belong to. New outputs are added to the last device.
+  """
+  def __init__(self, devices):
+    """Initializes the MultiController with a list of connected controllers."""
+    if not devices:
+      raise ValueError('A MultiController needs at least one device.')
+    super(BaseController, self).__init__()
+    self.devices = list(devices)
+    self.last_output_id = -1
+    self.layers = self.devices[0].layers
+    self.output_cls = self.devices[0].output_cls
+    self.metrics = metrics.MetricsGroup(
+        [device.metrics for device in self.devices])
+    for device in self.devices:
+      self.extend(device)
+
+  @classmethod
+  def FirstDevice(cls, outputs=5, device_cls=NewController, devices=2,
+                  patterns=DEVICE_PATTERNS, **kwds):
+    """Connects to the first `devices` suitable devices found.
+
+    Each of the devices is an instance of `device_cls` with `outputs` outputs,
+    and the further keyword arguments as options. See `FirstDevices` of the
+    device class for how the devices are found and ordered.
+    """
+    return cls(device_cls.FirstDevices(
+        devices, outputs=outputs, patterns=patterns, **kwds))
+
+  def Info(self):
+    """Returns a dictionary of Lightbox controller info, for all devices.
+
+    Frame mode and scheduling details are reported for each of the devices.
+    """
+    info = self.devices[0].Info()
+    info.update({
+        'controller': type(self).__name__,
+        'device': self._DeviceInfo(),
+        'commandRate': {
+            'combined': self.frequency,
+            'perOutput': 1 / self.period},
+        'frameMode': [device.frame_mode for device in self.devices],
+        'metronome': [device.metronome.Info() for device in self.devices],
+        'outputCount': len(self),
+        'writer': [device.writer.Info() for device in self.devices]})
+    return info
+
+  @property
+  def snapshot(self):
+    """Returns the state of the outputs of all devices."""
+    return sum((device.snapshot for device in self.devices), ())
+
+  def Post(self, output_id, action, options):
+    """Posts an action for the numbered output, to its device's Metronome."""
+    device_id, index = self._Locate(output_id)
+    self.devices[device_id].Post(index, action, options)
+
+  def PostBatch(self, commands):
+    """Posts a list of commands, grouped by device, to the devices' Metronomes.
+
+    The commands for each device are performed between the same two ticks of
+    that device. As the devices tick independently, commands for different
+    devices may be performed up to one tick apart.
+    """
+    batches = collections.defaultdict(list)
+    for output_id, action, options in commands:
+      device_id, index = self._Locate(output_id)
+      batches[device_id].append((index, action, options))
+    for device_id, batch in sorted(batches.items()):
+      self.devices[device_id].PostBatch(batch)
+
+  def PostLatest(self, output_id, layer, action, options):
+    """Posts a latest action for a layer, to its device's Metronome."""
+    device_id, index = self._Locate(output_id)
+    self.devices[device_id].PostLatest(index, layer, action, options)
+
+  def _DeviceInfo(self):
+    """Returns the hardware-specific info of each of the devices."""
+    return {'type': 'multi',
+            'devices': [device._DeviceInfo() for device in self.devices]}
+
+  # ############################################################################
+  # Output add/removal
+  #
+  def Add(self):
+    """Adds an output to the last device."""
+    device = self.devices[-1]
+    device.Add()
+    self.append(super(BaseController, device).__getitem__(-1))
+
+  def Remove(self):
+    """Removes an output from the last device that has any."""
+    device = next(device for device in reversed(self.devices) if device)
+    device.Remove()
+    self.pop()
+    if self.last_output_id >= len(self):
+      self.last_output_id = len(self) - 1
+
+  # ############################################################################
+  # Combined frequency and period
+  #
+  @property
+  def frequency(self):
+    """Returns the combined frequency of all devices."""
+    return sum(device.frequency for device in self.devices)
+
+  @property
+  def period(self):
+    """Returns the per-output update period of the slowest device."""
+    return max(device.period for device in self.devices)
+
+  # ############################################################################
+  # Commands, split up and sent to the devices
+  #
+  def SetAll(self, color):
+    """Sets the color for all outputs, on all devices."""
+    for device in self.devices:
+      device.SetAll(color)
+
+  def SetFrame(self, colors):
+    """Sets the colors for all outputs, in order, using a command per device."""
+    start = 0
+    for device in self.devices:
+      device.SetFrame(colors[start:start + len(device)])
+      start += len(device)
+
+  def SetMultiple(self, colors):
+    """Sets the colors for a number of outputs, given as (output, color) pairs.
+
+    The commands for all outputs of a device are written to it at once.
+    """
+    per_device = [[] for _device in self.devices]
+    for output, color in colors:
+      device_id, index = self._Locate(output)
+      per_device[device_id].append((index, color))
+    for device, device_colors in zip(self.devices, per_device):
+      if device_colors:
+        device.SetMultiple(device_colors)
+
+  def SetSingle(self, output, color):
+    """Sets the color for a single numbered output."""
+    device_id, index = self._Locate(output)
+    self.devices[device_id].SetSingle(index, color)
+
+  def _Locate(self, output):
+    """Returns the device number and the device's own number for an output.
+
+    Negative numbers count back from the last output, as for list indices.
+    """
+    if output < 0:
+      output += len(self)
+    if not 0 <= output < len(self):
+      raise IndexError('Output index out of range.')
+    for device_id, device in enumerate(self.devices):
+      if output < len(device):
+        return device_id, output
+      output -= len(device)
+
+
+# ##############################################################################
+# Device discovery and caching
+#
+def CandidatePorts(patterns):
+  """Returns the device names matching the glob pattern(s), in natural order."""
+  if isinstance(patterns, basestring):
+    patterns = patterns,
+  ports = []
+  for pattern in patterns:
+    ports.extend(sorted(glob.glob(pattern), key=lambda port: (len(port), port)))
+  return ports
+
+
+def ReadDeviceCache(path):
+  """Returns the cached device identity from the file at `path`, if any."""
+  if path is None:
+    return {}
+  try:
+    with file(path) as cache_file:
+      return simplejson.load(cache_file)
+  except (IOError, ValueError):
+    return {}
+
+
+def WriteDeviceCache(path, box, conn_info):
+  """Stores the port, controller type and frequency of the controller."""
+  if path is None:
+    return
+  temp_path = '%s.tmp' % path
+  try:
+    with file(temp_path, 'w') as cache_file:
+      simplejson.dump({'controller': type(box).__name__,
+                       'device': conn_info['device'],
+                       'frequency': box.frequency}, cache_file)
+    os.rename(temp_path, path)
+  except (IOError, OSError):
+    print 'Could not write device cache %r' % path
+
+
+def _CacheAfterDetection(path, box, conn_info):
+  """Stores the device in the cache once its frequency detection is done."""
+  box.detector.join()
+  if box.frequency_detected:
+    WriteDeviceCache(path, box, conn_info)
@@ -9,48 +9,77 @@ __version__ = '2.0'
 
 # Standard modules
 import BaseHTTPServer
+import collections
+import cStringIO
 import datetime
+import email.utils
+import gzip
+import hashlib
 import mimetypes
 import os
 import simplejson
+import socket
+import SocketServer
 import sys
+import threading
+import time
+import urlparse
 
 # Package modules
 from . import light
 from . import utils
 
+# Maximum number of messages per second sent to output stream clients.
+STREAM_RATE = 25
+# Directory of the web interface, and how long browsers may cache its assets.
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+STATIC_MAX_AGE = 86400
+
 
 class ApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   """Ligtbox JSON API Handler."""
   def do_GET(self):
     """Very basic request router."""
-    path = self.path
+    path, _sep, query = self.path.partition('?')
     if path == '/':
       return self._Redirect('/static/api.html')
     elif path == '/api':
       return self.ControllerInfo()
     elif path == '/api/outputs':
       return self.OutputInfo()
+    elif path == '/api/metrics':
+      return self.MetricsInfo(urlparse.parse_qs(query))
+    elif path == '/api/stream':
+      return self.StreamOutputs()
     elif path.startswith('/static/'):
       return self.ServeStatic()
     return self._ErrorResponse('No path %r. Try the root please.' % path)
 
   def _ErrorResponse(self, error):
-    """Something didn't quite go as planned, let's tell the client something."""
+    """Something didn't quite go as planned, let's tell the client something.
+
+    The connection is closed after this, as the request may not have been read
+    completely.
+    """
+    self.close_connection = True
     self.send_response(400)
+    self.send_header('connection', 'close')
     self.send_header('content-type', 'text/plain')
+    self.send_header('content-length', len(error))
     self.end_headers()
     self.wfile.write(error)
 
-  def _JsonResponse(self, data):
+  def _JsonResponse(self, data, code=200):
     """Successful request, send response to client as JSON."""
-    return self._SuccessResponse(simplejson.dumps(data), 'application/json')
+    return self._SuccessResponse(
+        simplejson.dumps(data), 'application/json', code=code)
 
-  def _SuccessResponse(self, data, content_type, max_age=0):
-    """Returns a 200 OK with the given data and content-type."""
-    self.send_response(200)
+  def _SuccessResponse(self, data, content_type, code=200):
+    """Returns the given data and content-type, with a 200 OK by default."""
+    self.send_response(code)
+    self.send_header('cache-control', 'no-cache')
     self.send_header('content-type', content_type)
-    self.send_header('max-age', max_age)
+    self.send_header('content-length', len(data))
     self.end_headers()
     self.wfile.write(data)
 
@@ -58,6 +87,7 @@ class ApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """Redirects the client to the new location."""
     self.send_response(code)
     self.send_header('location', location)
+    self.send_header('content-length', len(location))
     self.end_headers()
     self.wfile.write(location)
 
@@ -65,39 +95,98 @@ class ApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """Returns a JSON object with controller information."""
     self._JsonResponse(self.server.box.Info())
 
+  def MetricsInfo(self, query):
+    """Returns the controller's performance metrics.
+
+    These are returned as JSON, or in the plain text exposition format if the
+    query specifies `format=text`.
+    """
+    box_metrics = self.server.box.metrics
+    if query.get('format') == ['text']:
+      return self._SuccessResponse(
+          box_metrics.Exposition(), 'text/plain; version=0.0.4')
+    self._JsonResponse(box_metrics.Info())
+
   def ServeStatic(self):
-    """Returns files from the 'static' directory."""
-    requested = os.path.abspath(self.path)
-    if not requested.startswith('/static'):
-      return self._ErrorResponse('Request not permitted: %r' % self.path)
-    static_path = os.path.join(os.path.dirname(__file__), requested[1:])
-    try:
-      with file(static_path) as static_file:
-        content_type, _encoding = mimetypes.guess_type(static_path)
-        if not content_type:
-          content_type = 'text/plain'
-        return self._SuccessResponse(
-            static_file.read(), content_type, max_age=86400)
-    except IOError:
+    """Returns files from the 'static' directory, from the server's cache.
+
+    Files are sent gzipped to clients that accept it. Clients that send the
+    ETag or modification time of their cached copy get a 304 Not Modified if
+    the file is unchanged.
+    """
+    path = self.path.partition('?')[0]
+    asset = self.server.static.get(path[len('/static/'):])
+    if asset is None:
       self.log_error('File not found: %r', self.path)
       return self._ErrorResponse('File not found: %r' % self.path)
+    content, etag = asset.content, asset.etag
+    if asset.gzipped is not None and AcceptsGzip(
+        self.headers.get('accept-encoding', '')):
+      content, etag = asset.gzipped, asset.gzipped_etag
+    modified = NotModified(self.headers, etag, asset.mtime)
+    self.send_response(304 if modified else 200)
+    self.send_header('cache-control', asset.cache_control)
+    self.send_header('etag', etag)
+    self.send_header('last-modified', self.date_time_string(asset.mtime))
+    if asset.gzipped is not None:
+      self.send_header('vary', 'accept-encoding')
+    if modified:
+      return self.end_headers()
+    if content is asset.gzipped:
+      self.send_header('content-encoding', 'gzip')
+    self.send_header('content-type', asset.content_type)
+    self.send_header('content-length', len(content))
+    self.end_headers()
+    self.wfile.write(content)
 
   def OutputInfo(self):
-    """Returns a JSON object with Lightbox output information."""
-    outputs = []
-    for output_id, output in enumerate(self.server.box):
-      outputs.append({
-          'outputNumber': output_id,
-          'mixedColorRgb': output.color,
-          'mixedColorHex': '#%02x%02x%02x' % tuple(output.color),
-          'layers': list(LayerReport(output))})
-    self._JsonResponse(outputs)
+    """Returns a JSON object with Lightbox output information.
+
+    The information is taken from the controller's snapshot of its outputs, so
+    it is consistent for all outputs and their layers.
+    """
+    self._JsonResponse([OutputReport(output_id, output) for output_id, output
+                        in enumerate(self.server.box.snapshot)])
+
+  def StreamOutputs(self):
+    """Streams changes in output information as server-sent events.
+
+    The first message holds the information of all outputs, as /api/outputs
+    does. Each following message holds only the outputs that changed since the
+    previous one. Messages are shared by all clients, and their rate is limited
+    by the server's OutputStream. This requires the threaded server, as the
+    response lasts until the client disconnects.
+    """
+    stream = self.server.stream
+    if stream is None:
+      return self._ErrorResponse('Streaming requires the threaded server.')
+    self.close_connection = True
+    self.send_response(200)
+    self.send_header('cache-control', 'no-cache')
+    self.send_header('connection', 'close')
+    self.send_header('content-type', 'text/event-stream')
+    self.end_headers()
+    sequence, reports, _message = stream.Latest()
+    message = DeltaMessage(None, reports)
+    try:
+      while True:
+        if message:
+          self.wfile.write(message)
+          self.wfile.flush()
+        seen = reports
+        next_sequence, reports, message = stream.Wait(sequence)
+        if next_sequence != sequence + 1:
+          # Messages were missed, send the changes since the last one seen.
+          message = DeltaMessage(seen, reports)
+        sequence = next_sequence
+    except socket.error:
+      self.log_message('Stream client disconnected.')
 
   def do_POST(self):
     """Processes Lightbox controls via JSON."""
-    if self.path != '/api':
+    if self.path not in ('/api', '/api/batch'):
       self.log_error('Received POST on address other than /api.')
-      return self._ErrorResponse('Can only write to /api.')
+      return self._ErrorResponse('Can only write to /api and /api/batch.')
     content_type = self.headers['content-type'].split(';')[0]
     if content_type != 'application/json':
       self.log_error(
@@ -106,39 +195,58 @@ class ApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     if 'content-length' not in self.headers:
       self.log_error('Received POST without a specified content-length.')
       return self._ErrorResponse('Headers must provide the message length.')
-    payload = simplejson.loads(
-        self.rfile.read(int(self.headers['content-length'])))
-    if isinstance(payload, list):
-      map(self.ProcessCommand, payload)
-    else:
-      self.ProcessCommand(payload)
+    try:
+      payload = simplejson.loads(
+          self.rfile.read(int(self.headers['content-length'])))
+    except ValueError as error:
+      self.log_error('Received POST with malformed JSON: %s', error)
+      return self._ErrorResponse('Malformed JSON: %s' % error)
+    if self.path == '/api/batch':
+      return self.ProcessBatch(payload)
+    if not isinstance(payload, list):
+      payload = [payload]
+    self.ProcessCommands(payload)
+
+  def ProcessCommands(self, api_commands):
+    """Posts the given commands to the Lightbox instance, if all are valid.
+
+    The commands are performed by the controller's Metronome, before its next
+    tick. They are checked beforehand, see `CheckCommand`; if any is invalid,
+    none is posted and the error is returned to the client.
+    """
+    box = self.server.box
+    try:
+      commands = [CheckCommand(box, command) for command in api_commands]
+    except (TypeError, ValueError) as error:
+      self.log_error('Received invalid command: %s', error)
+      return self._ErrorResponse('Invalid command: %s' % error)
+    for output_id, action, options in commands:
+      box.Post(output_id, action, options)
     self.send_response(200)
+    self.send_header('content-length', 0)
     self.end_headers()
 
-  def ProcessCommand(self, api_command):
-    """Performs the given command on the Lightbox instance.
+  def ProcessBatch(self, api_commands):
+    """Posts the given list of commands to be performed together, or none.
 
-    Envelope and blend method are loaded by name from the utils module. The
-    handling method is selected from a string as well, defaulting to 'Fade' if
-    none is provided.
+    All commands are checked before any is posted, see `ParseBatch`. If all are
+    valid, they are performed between the same two ticks of the controller, so
+    that changes to several outputs show in the same frame. The response holds
+    the result of each command, and whether the batch was applied.
     """
-    command = api_command.copy()
-    if 'blender' in command:
-      if not hasattr(utils.Blenders, command['blender']):
-        raise ValueError('Provided blender %r is not a known blender.' % (
-            command['blender']))
-      command['blender'] = getattr(utils.Blenders, command['blender'])
-    if 'envelope' in command:
-      if not hasattr(utils.Envelopes, command['envelope']):
-        raise ValueError('Provided envelope %r is not a known envelope.' % (
-            command['envelope']))
-      command['envelope'] = getattr(utils.Envelopes, command['envelope'])
-    channel = self.server.box[command.get('output', 0)]
-    api_command['action'] = action = command.get('action', 'fade').capitalize()
-    if not hasattr(light.ActionsMixIn, action):
-      raise ValueError(
-          'Chosen action %r is not an action for this channel.' %  action)
-    getattr(channel, action)(**command)
+    if not isinstance(api_commands, list):
+      return self._ErrorResponse('Batch must be a list of commands.')
+    box = self.server.box
+    commands, results = ParseBatch(box, api_commands)
+    applied = len(commands) == len(api_commands)
+    if applied:
+      box.PostBatch(commands)
+    else:
+      for result in results:
+        if result['status'] == 'ok':
+          result['status'] = 'skipped'
+    self._JsonResponse({'applied': applied, 'results': results},
+                       code=200 if applied else 400)
 
   def log_error(self, fmt, *args):
     """Logs an error by prefixing 'Error' and sending it to log_message."""
@@ -157,17 +265,312 @@ class ApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
           fmt % args))
 
 
-def ApiServer(box, port=8000, quiet=False):
-  """Starts and runs a JSON API server for the given Lightbox controller."""
-  server = BaseHTTPServer.HTTPServer(('0.0.0.0', port), ApiHandler)
+class KeepAliveApiHandler(ApiHandler):
+  """Lightbox JSON API Handler that keeps connections open for more requests.
+
+  Connections that are idle for `timeout` seconds are closed. Responses are
+  buffered and sent at once, without delay by Nagle's algorithm.
+  """
+  disable_nagle_algorithm = True
+  protocol_version = 'HTTP/1.1'
+  timeout = 30
+  wbufsize = -1
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+  """HTTP server that handles each connection in its own thread."""
+  daemon_threads = True
+
+
+StaticAsset = collections.namedtuple('StaticAsset', (
+    'content', 'content_type', 'etag', 'gzipped', 'gzipped_etag', 'mtime',
+    'cache_control'))
+
+
+def LoadStatic(directory=STATIC_DIR, max_age=STATIC_MAX_AGE):
+  """Returns a dictionary of StaticAssets for all files in the directory.
+
+  Assets are keyed by their path relative to the directory. Text assets are
+  compressed once, here, and their gzipped variant is kept if it is smaller.
+  ETags are derived from the content, and differ between the variants. HTML
+  pages are revalidated on each use, other assets may be cached for `max_age`
+  seconds.
+  """
+  assets = {}
+  for root, _dirs, filenames in os.walk(directory):
+    for filename in filenames:
+      path = os.path.join(root, filename)
+      with open(path, 'rb') as static_file:
+        content = static_file.read()
+      content_type = mimetypes.guess_type(path)[0] or 'text/plain'
+      etag = '"%s"' % hashlib.sha1(content).hexdigest()
+      gzipped = gzipped_etag = None
+      if content_type.startswith('text/') or content_type.endswith(
+          ('javascript', 'json', 'xml')):
+        gzipped = _Gzip(content)
+        if len(gzipped) < len(content):
+          gzipped_etag = '%s-gzip"' % etag[:-1]
+        else:
+          gzipped = None
+      if content_type == 'text/html':
+        cache_control = 'no-cache'
+      else:
+        cache_control = 'public, max-age=%d' % max_age
+      name = os.path.relpath(path, directory).replace(os.sep, '/')
+      assets[name] = StaticAsset(
+          content, content_type, etag, gzipped, gzipped_etag,
+          int(os.path.getmtime(path)), cache_control)
+  return assets
+
+
+def AcceptsGzip(accept_encoding):
+  """Returns whether the Accept-Encoding header value allows gzip."""
+  for coding in accept_encoding.split(','):
+    name, _sep, params = coding.partition(';')
+    if name.strip().lower() in ('gzip', '*'):
+      params = params.replace(' ', '')
+      if not params.startswith('q='):
+        return True
+      try:
+        return float(params[2:]) > 0
+      except ValueError:
+        return False
+  return False
+
+
+def NotModified(headers, etag, mtime):
+  """Returns whether the request's conditional headers match the asset.
+
+  If-None-Match is checked against the ETag if it is given, otherwise the
+  If-Modified-Since date is compared with the modification time.
+  """
+  if_none_match = headers.get('if-none-match')
+  if if_none_match is not None:
+    tags = [tag.strip().replace('W/', '', 1)
+            for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+  if_modified_since = headers.get('if-modified-since')
+  if if_modified_since is not None:
+    since = email.utils.parsedate_tz(if_modified_since)
+    return since is not None and mtime <= email.utils.mktime_tz(since)
+  return False
+
+
+def _Gzip(content):
+  """Returns the content compressed with gzip, without a timestamp."""
+  buf = cStringIO.StringIO()
+  with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as zfile:
+    zfile.write(content)
+  return buf.getvalue()
+
+
+class OutputStream(threading.Thread):
+  """Publishes the changes in the outputs of a controller, for streaming.
+
+  The controller's snapshot is checked up to `rate` times per second. If any
+  output changed, a message with the information of only those outputs is
+  created, once for all clients. Only outputs whose state was taken anew in
+  the snapshot are reported again to check for changes.
+  """
+  def __init__(self, box, rate=STREAM_RATE):
+    super(OutputStream, self).__init__(name=type(self).__name__)
+    self.box = box
+    self.message = None
+    self.period = 1.0 / rate
+    self.published = threading.Condition(threading.Lock())
+    self.reports = []
+    self.sequence = 0
+    self.snapshot = ()
+    # Daemonize and run
+    self.daemon = True
+    self.start()
+
+  def Latest(self):
+    """Returns the latest sequence number, output reports and message."""
+    with self.published:
+      return self.sequence, self.reports, self.message
+
+  def Wait(self, sequence):
+    """Returns the sequence number, reports and message following `sequence`."""
+    with self.published:
+      while self.sequence == sequence:
+        self.published.wait()
+      return self.sequence, self.reports, self.message
+
+  def run(self):
+    """Checks the snapshot for changes, and publishes them as a message."""
+    while True:
+      snapshot = self.box.snapshot
+      if snapshot is not self.snapshot:
+        previous = dict(enumerate(zip(self.snapshot, self.reports)))
+        reports = []
+        for output_id, output in enumerate(snapshot):
+          state, report = previous.get(output_id, (None, None))
+          if output is not state:
+            report = OutputReport(output_id, output)
+          reports.append(report)
+        message = DeltaMessage(self.reports, reports)
+        with self.published:
+          self.snapshot = snapshot
+          self.reports = reports
+          if message:
+            self.message = message
+            self.sequence += 1
+            self.published.notifyAll()
+      time.sleep(self.period)
+
+
+def ApiServer(box, port=8000, quiet=False, threaded=False,
+              stream_rate=STREAM_RATE):
+  """Starts and runs a JSON API server for the given Lightbox controller.
+
+  The default server handles one request at a time, closing the connection
+  after each. A `threaded` server handles connections concurrently, and keeps
+  them open for further requests (HTTP/1.1 keep-alive). It also streams output
+  changes from /api/stream, up to `stream_rate` messages per second.
+  """
+  if threaded:
+    server = ThreadedHTTPServer(('0.0.0.0', port), KeepAliveApiHandler)
+    server.stream = OutputStream(box, rate=stream_rate)
+  else:
+    server = BaseHTTPServer.HTTPServer(('0.0.0.0', port), ApiHandler)
+    server.stream = None
   server.box = box
+  server.static = LoadStatic()
   server.verbose = not quiet
   server.serve_forever()
 
 
+def ParseCommand(api_command):
+  """Returns the output number, action and options for the given API command.
+
+  Envelope and blend method are loaded by name from the utils module. The
+  handling method is selected from a string as well, defaulting to 'Fade' if
+  none is provided. Unknown names, and actions that are not strings, raise
+  ValueError.
+  """
+  command = api_command.copy()
+  if 'blender' in command:
+    if not hasattr(utils.Blenders, command['blender']):
+      raise ValueError('Provided blender %r is not a known blender.' % (
+          command['blender']))
+    command['blender'] = getattr(utils.Blenders, command['blender'])
+  if 'envelope' in command:
+    if not hasattr(utils.Envelopes, command['envelope']):
+      raise ValueError('Provided envelope %r is not a known envelope.' % (
+          command['envelope']))
+    command['envelope'] = getattr(utils.Envelopes, command['envelope'])
+  action = command.get('action', 'fade')
+  if not isinstance(action, basestring):
+    raise ValueError('Action must be a string, not %r.' % (action,))
+  action = action.capitalize()
+  if not hasattr(light.ActionsMixIn, action):
+    raise ValueError(
+        'Chosen action %r is not an action for this channel.' %  action)
+  return command.get('output', 0), action, command
+
+
+def CheckCommand(box, api_command):
+  """Returns the output number, action and options for a valid API command.
+
+  Besides the checks of `ParseCommand`, the output and layer numbers must exist
+  on the controller, and the color, opacity and timing must be valid, as must
+  the `count` and `queue` options. The `lab` option is set from the color by
+  `ParseBatch` only, and `clock` is for offline rendering; commands that provide
+  either are refused. Invalid commands raise ValueError or TypeError.
+  """
+  if not isinstance(api_command, dict):
+    raise ValueError('Command must be an object.')
+  output_id, action, options = ParseCommand(api_command)
+  snapshot = box.snapshot
+  if not isinstance(output_id, int) or not 0 <= output_id < len(snapshot):
+    raise ValueError('Output %r does not exist.' % (output_id,))
+  layer = options.get('layer', 0)
+  if (not isinstance(layer, int) or
+      not 0 <= layer < len(snapshot[output_id].layers)):
+    raise ValueError('Layer %r does not exist.' % (layer,))
+  if 'lab' in options:
+    raise ValueError('Option lab is not allowed, provide a color instead.')
+  if 'clock' in options:
+    raise ValueError('Option clock is not allowed.')
+  if 'color' in options:
+    options['color'] = _CheckedColor(options['color'])
+  count = options.get('count', 1)
+  if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+    raise ValueError('Count %r is not a non-negative integer.' % (count,))
+  if not isinstance(options.get('queue', True), bool):
+    raise ValueError('Queue %r is not a boolean.' % (options['queue'],))
+  light.Transition(**dict(options, lab=(0, 0, 0)))
+  return output_id, action, options
+
+
+def ParseBatch(box, api_commands):
+  """Returns the parsed commands that are valid, and the result for each.
+
+  Each command is checked by `CheckCommand`. Colors of all valid commands are
+  converted to Lab together, and passed to the actions as `lab`. Each result
+  is a dictionary with a 'status' of 'ok' or 'error', the latter with a message
+  under 'error'.
+  """
+  parsed = []
+  results = []
+  for api_command in api_commands:
+    try:
+      output_id, action, options = CheckCommand(box, api_command)
+    except (TypeError, ValueError) as error:
+      results.append({'status': 'error', 'error': str(error)})
+    else:
+      parsed.append((output_id, action, options))
+      results.append({'status': 'ok', 'output': output_id, 'action': action})
+  colored = [options for _output_id, _action, options in parsed
+             if 'color' in options]
+  lab_colors = utils.RgbColorsToLab([options['color'] for options in colored])
+  for options, lab_color in zip(colored, lab_colors):
+    options['lab'] = lab_color
+  return parsed, results
+
+
+def _CheckedColor(color):
+  """Returns the color as an RGB tuple, or raises ValueError if invalid."""
+  if isinstance(color, basestring):
+    return utils.HexToRgb(color)
+  if (not isinstance(color, (list, tuple)) or len(color) != 3 or
+      not all(isinstance(chan, (int, float)) for chan in color)):
+    raise ValueError('Color %r is not a hex string or RGB triplet.' % (color,))
+  return tuple(color)
+
+
+def DeltaMessage(old_reports, new_reports):
+  """Returns a server-sent event with the output reports that have changed.
+
+  Reports are compared by position; without `old_reports`, all are included.
+  If no report changed, None is returned.
+  """
+  old_reports = old_reports or []
+  changed = [report for index, report in enumerate(new_reports)
+             if index >= len(old_reports) or report != old_reports[index]]
+  if changed:
+    return 'data: %s\n\n' % simplejson.dumps(changed)
+
+
+def OutputReport(output_id, output):
+  """Returns a dictionary with the state of the output and its layers.
+
+  The output is given as an OutputState, as taken for the controller snapshot.
+  """
+  return {'outputNumber': output_id,
+          'mixedColorRgb': output.color,
+          'mixedColorHex': '#%02x%02x%02x' % tuple(output.color),
+          'layers': list(LayerReport(output))}
+
+
 def LayerReport(output):
-  """Yields a dictionary with the state of each layer in the given output."""
-  for layer in output:
+  """Yields a dictionary with the state of each layer in the given output.
+
+  The output is given as an OutputState, as taken for the controller snapshot.
+  """
+  for layer in output.layers:
     yield {'blender': layer.blender.__name__,
            'envelope': layer.envelope.__name__,
            'colorRgb': layer.color,
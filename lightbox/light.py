@@ -3,16 +3,32 @@
 
 This module contains the abstraction for the output lights, with various
 methods that cause the lights to change in different manners.
+
+Colors are carried through layers, transitions and blenders in CIELAB space,
+and are only converted to RGB once, after all layers of an output are mixed.
 """
 __author__ = 'Elmer de Looff <elmer@underdark.nl>'
 __version__ = '2.0'
 
 # Standard modules
 import collections
+import math
+
+# Third-party modules
+import numpy
 
 # Application modules
 import utils
 
+LAB_BLACK = 0, 0, 0
+
+# Milliseconds per precomputed frame of transitions with a duration.
+DURATION_RESOLUTION = 5
+# Largest number of steps, and longest duration (in milliseconds), that a
+# transition accepts. Every step is a precomputed frame, held in memory.
+MAX_STEPS = 100000
+MAX_DURATION = 3600000
+
 
 class ActionsMixIn(object):
   """Provides the common actions for Output classes."""
@@ -23,24 +39,31 @@ class ActionsMixIn(object):
       self[layer].Append(Transition(**options))
 
   def Constant(self, layer=0, **options):
-    """Instantly cuts the output over to the given RGB values."""
+    """Instantly cuts the output over to the given RGB values.
+
+    With a `duration`, the output stays like that for the given number of
+    milliseconds, before the next queued transition starts.
+    """
     options['steps'] = 1
+    options['hold'] = 'duration' in options
     self[layer].Append(Transition(**options))
 
   def Fade(self, layer=0, **options):
-    """Fades the output to the given `color` in `steps` steps."""
+    """Fades the output to the given `color` in `steps` steps or `duration`."""
     self[layer].Append(Transition(**options))
 
 
 class Output(ActionsMixIn):
   """Abstraction for an RGB output.
 
-  Allows color changing using the associated controller.
+  Allows color changing using the associated controller. Outputs track whether
+  any of their layers changed, so that unchanged outputs need not be mixed.
   """
   def __init__(self, layers=3):
     super(Output, self).__init__()
     self.color = 0, 0, 0
     self.layers = [Layer() for _number in range(max(1, layers))]
+    self._dirty = True
 
   # ############################################################################
   # Actual color changing/writing and layer management
@@ -53,16 +76,23 @@ class Output(ActionsMixIn):
     """Returns an iterator for the Layer objects in the output."""
     return iter(self.layers)
 
+  @property
+  def dirty(self):
+    """Returns whether the output's color may have changed since last mixed."""
+    return self._dirty or any(layer.dirty for layer in self.layers)
+
   def next(self):
-    """Returns the combined next color for the output."""
+    """Returns the combined next color for the output, as RGB."""
+    self._dirty = False
     color, _opacity = next(self[0])
     for layer in self[1:]:
       color = layer.NextBlendedColor(color)
-    return tuple(map(int, color))
+    return tuple(int(round(chan)) for chan in utils.LabToRgb(color))
 
   def AddLayer(self):
     """Adds an additional layer to this output."""
     self.layers.append(Layer())
+    self._dirty = True
 
   def DeleteLayer(self, index=None):
     """Deletes the topmost layer from the output, or layer at `index` if given.
@@ -73,24 +103,107 @@ class Output(ActionsMixIn):
       raise ValueError('May not remove the last layer.')
     index = -1 if index is None else index
     self.layers.pop(index)
+    self._dirty = True
+
+  def Skip(self, frames):
+    """Advances all layers by the given number of frames, without mixing.
+
+    The output is marked dirty, so the frame reached is mixed on the next
+    update, even if the layers' transitions ended while skipping.
+    """
+    for layer in self.layers:
+      layer.Skip(frames)
+    self._dirty = True
 
   def NewColor(self):
     """Calculates and returns the new color tuple for this output.
 
     If the new color is the same as the current color, None is returned instead
-    of an RGB color tuple.
+    of an RGB color tuple. Outputs without changes are not mixed at all.
+    """
+    if self.dirty:
+      return self.StoreColor(next(self))
+
+  def StoreColor(self, new_color):
+    """Stores the given mixed color as the output's color.
+
+    Returns the color if it differs from the current color, None otherwise.
     """
-    new_color = next(self)
     if new_color != self.color:
       self.color = new_color
       return new_color
 
+  def Snapshot(self):
+    """Returns the current state of the output and its layers."""
+    return OutputState(self.color, tuple(layer.Snapshot() for layer in self))
+
+
+class OutputState(collections.namedtuple('OutputState', 'color layers')):
+  """Immutable state of an output: its mixed RGB color and its LayerStates."""
+  __slots__ = ()
+
+
+class LayerState(collections.namedtuple(
+    'LayerState', 'lab opacity blender envelope')):
+  """Immutable state of a layer, with its color in Lab."""
+  __slots__ = ()
+
+  @property
+  def color(self):
+    """Returns the color of the layer as an RGB tuple."""
+    return tuple(int(round(chan)) for chan in utils.LabToRgb(self.lab))
+
+
+def MixOutputs(outputs):
+  """Returns the next mixed color for each of the given outputs.
+
+  This is the whole-frame equivalent of calling `next` on each of the outputs.
+  The Lab colors and opacities of all layers are gathered into arrays, layers
+  are blended for all outputs in one vectorized pass per layer and blender, and
+  the mixed colors are converted to RGB in one final pass.
+  Blenders without an array counterpart in `utils.ARRAY_BLENDERS` are applied
+  to the outputs that use them one at a time.
+  """
+  if not outputs:
+    return []
+  depth = max(len(output.layers) for output in outputs)
+  frames = []
+  groups = [collections.defaultdict(list) for _layer in range(depth)]
+  for out_index, output in enumerate(outputs):
+    output._dirty = False
+    output_frames = [next(layer) for layer in output]
+    for layer_index, layer in enumerate(output):
+      groups[layer_index][layer.blender].append(out_index)
+    output_frames.extend([(LAB_BLACK, 0)] * (depth - len(output_frames)))
+    frames.append(output_frames)
+  colors = numpy.array([[color for color, _opacity in output_frames]
+                        for output_frames in frames], dtype=float)
+  opacities = numpy.array([[opacity for _color, opacity in output_frames]
+                           for output_frames in frames], dtype=float)
+  mixed = colors[:, 0].copy()
+  for layer_index in range(1, depth):
+    for blender, indices in groups[layer_index].iteritems():
+      overlay = colors[indices, layer_index]
+      opacity = opacities[indices, layer_index]
+      array_blender = utils.ARRAY_BLENDERS.get(blender)
+      if array_blender is not None:
+        mixed[indices] = array_blender(mixed[indices], overlay, opacity)
+        continue
+      for index, color, layer_opacity in zip(indices, overlay, opacity):
+        mixed[index] = blender(tuple(mixed[index]), tuple(color), layer_opacity)
+  rgb = numpy.rint(utils.LabArrayToRgb(mixed)).astype(int)
+  return map(tuple, rgb.tolist())
+
 
 class Layer(object):
   """A single color layer that goes into a LayerMixer to mix colors.
 
   An iterator that yields colors throughout transitions. When no transition is
-  available, the last yielded color will be yielded indifinitely.
+  available, the last yielded color will be yielded indifinitely. Colors are
+  yielded as Lab tuples, the `color` property provides the RGB equivalent.
+
+  The layer is marked `dirty` while it has transitions to play or was changed,
+  and becomes clean once it yields its final color again.
 
   N.B. Only Transition objects can be appended to this structure.
   """
@@ -98,12 +211,13 @@ class Layer(object):
     """Initliazes a Layer."""
     # Layer management
     self.blender = opts.get('blender', utils.Blenders.LabAverage)
-    self.color = opts.get('color', (0, 0, 0))
+    self.lab = utils.RgbToLab(opts.get('color', (0, 0, 0)))
     self.opacity = opts.get('opacity', 0)
     # Transition management
     self.envelope = opts.get('envelope', utils.Envelopes.Cosine)
     self.queue = collections.deque()
     self.transition = None
+    self.dirty = True
 
   def Append(self, transition):
     """Adds a new transition to be played after the current one.
@@ -117,44 +231,71 @@ class Layer(object):
     else:
       self.NewTransition(transition)
       self.queue.clear()
+    self.dirty = True
 
   def Kill(self):
     """Resets the Layer, immediately disabling output."""
-    self.color = 0, 0, 0
+    self.lab = LAB_BLACK
     self.opacity = 0
     self.queue = collections.deque()
     self.transition = None
+    self.dirty = True
+
+  @property
+  def color(self):
+    """Returns the current color of the layer as an RGB tuple."""
+    return tuple(int(round(chan)) for chan in utils.LabToRgb(self.lab))
+
+  @color.setter
+  def color(self, color):
+    """Sets the current color of the layer from an RGB tuple or hex string."""
+    self.lab = utils.RgbToLab(color)
+    self.dirty = True
 
   def NewTransition(self, transition):
     """Installs the new transition and blender."""
     self.blender = transition.blender or self.blender
-    self.transition = transition.Start(self.color, self.opacity, self.envelope)
+    self.transition = transition.Start(self.lab, self.opacity, self.envelope)
+    self.dirty = True
 
   def NextBlendedColor(self, base):
     """Returns the next blended color for this Layer.
 
     The layer's own next color is blended with the given base color,
-    proportional to the layer's opacity.
+    proportional to the layer's opacity. Both colors are Lab tuples.
     """
     overlay, opacity = next(self)
     return self.blender(base, overlay, opacity)
 
+  def Snapshot(self):
+    """Returns the current state of the layer, as LayerState."""
+    return LayerState(self.lab, self.opacity, self.blender, self.envelope)
+
+  def Skip(self, frames):
+    """Advances the layer by the given number of frames."""
+    for _frame in range(frames):
+      next(self)
+
   def next(self):
-    """Steps through the current transition and returns color and opacity.
+    """Steps through the current transition and returns Lab color and opacity.
 
     If there are no transitions queued up, this will return the current color
-    and opacity instead.
+    and opacity instead, and the layer is marked clean.
     """
-    try:
-      self.color, self.opacity = next(self.transition)
-      return self.color, self.opacity
-    except (StopIteration, TypeError):
-      if not self.queue:
-        # No new transitions are queued up; return the current values
-        return self.color, self.opacity
-      # Load a new transition and set transition information
-      self.NewTransition(self.queue.popleft())
-      return next(self)
+    if self.transition is not None:
+      try:
+        self.lab, self.opacity = next(self.transition)
+        return self.lab, self.opacity
+      except StopIteration:
+        self.transition = None
+    # Marked clean before checking the queue, so a concurrent Append is kept.
+    self.dirty = False
+    if not self.queue:
+      # No new transitions are queued up; return the current values
+      return self.lab, self.opacity
+    # Load a new transition and set transition information
+    self.NewTransition(self.queue.popleft())
+    return next(self)
 
 
 class Transition(object):
@@ -171,11 +312,21 @@ class Transition(object):
     will be used to generate appropriate output streams.
 
     Arguments:
-      @ steps: int
-        The number of steps the transition should be completed in.
+      % steps: int ~~ 1
+        The number of steps the transition should be completed in, at most
+        MAX_STEPS. If a `duration` is given, this is the number of distinct
+        frames instead.
+      % duration: float
+        Duration of the transition in milliseconds, at most MAX_DURATION. The
+        frame to display is then determined by the time elapsed since the
+        transition started, regardless of the update frequency of the
+        controller.
       % color: 3-tuple of int
         Red, green and blue values that the transition should move to. If no
         color is given, it will remain as it was at the start of the transition.
+      % lab: 3-tuple of float
+        The target color as L*, a* and b* values, already converted from the
+        given `color`. This takes precedence over the `color` option.
       % opacity: float
         Opacity value that the transition should move towards. If no opacity is
         given, it will remain as it was at the start of the transition.
@@ -187,25 +338,49 @@ class Transition(object):
         Envlope to apply to the color transition. This is used to provide
         different smoothings to the transition. If not given, the envelope
         function in use at time of the start of this transition is used.
+      % hold: bool ~~ False
+        Whether the final frame is held until the `duration` has passed, rather
+        than ending the transition once it is reached.
+      % clock: function ~~ utils.MonotonicTime
+        The clock by which a transition with a `duration` keeps time.
     """
-    self.steps = int(opts.get('steps', 1))
-    if self.steps <= 0:
-      raise ValueError('Steps argument must be at least 1.')
-    self.color = utils.RgbToLab(opts.get('color')) if 'color' in opts else None
+    self.duration = opts.get('duration')
+    if self.duration is not None:
+      self.duration = float(self.duration)
+      if not 0 <= self.duration <= MAX_DURATION:
+        raise ValueError('Duration argument must be from 0 to %d.' % (
+            MAX_DURATION))
+      default_steps = min(
+          MAX_STEPS, math.ceil(self.duration / DURATION_RESOLUTION))
+    else:
+      default_steps = 1
+    self.steps = int(opts.get('steps', max(1, default_steps)))
+    if not 1 <= self.steps <= MAX_STEPS:
+      raise ValueError('Steps argument must be from 1 to %d.' % MAX_STEPS)
+    opacity = opts.get('opacity', 0)
+    if not isinstance(opacity, (int, float)) or not 0 <= opacity <= 1:
+      raise ValueError('Opacity argument must be a number from 0 to 1.')
+    if 'lab' in opts:
+      self.color = tuple(opts['lab'])
+    elif 'color' in opts:
+      self.color = utils.RgbToLab(opts['color'])
+    else:
+      self.color = None
     self.blender = opts.get('blender', None)
     self.options = opts
 
   def Start(self, color, opacity, envelope):
-    """Generator for colortuples from the given color to the pre-set target.
+    """Returns a FrameTable from the given color to the pre-set target.
 
-    The starting color is first converted to CIELAB colorspace. Using the start
-    and target colors, the difference is determined and the envelope function
-    together with the number of steps will yield the requested number of steps
-    to reach the preset target color.
+    Using the start and target colors in CIELAB colorspace, the difference is
+    determined and the envelope function together with the number of steps
+    determine the intermediate colors to reach the preset target color. All
+    frames are computed here, once, so that playing back the transition is a
+    matter of stepping through the table.
 
     Arguments:
-      @ color: 3-tuple of int
-        Red, green and blue values to start the transition from.
+      @ color: 3-tuple of float
+        L*, a* and b* values to start the transition from.
       @ opacity: float
         Opacity value that the transition should start with.
       @ envelope: function
@@ -213,18 +388,108 @@ class Transition(object):
         is no explicit envelope set for this transition, the previous one will
         be used.
     """
-    lab_begin, lab_diff = self._LabDiff(color)
+    envelope = self.options.get('envelope', envelope)
+    factors = numpy.zeros(self.steps + 1)
+    factors[1:] = utils.EnvelopeFactors(envelope, self.steps)
+    lab_begin = numpy.array(color, dtype=float)
+    lab_target = lab_begin if self.color is None else numpy.array(self.color)
     opacity_diff = self.options.get('opacity', opacity) - opacity
-    for factor in self.options.get('envelope', envelope)(self.steps):
-      yield (utils.LabToRgb(base + diff * factor for base, diff
-                            in zip(lab_begin, lab_diff)),
-             opacity + opacity_diff * factor)
-    if self.options.get('withreverse', False):
-      for factor in self.options.get('envelope', envelope)(self.steps):
-        yield (utils.LabToRgb(base + diff * (1 - factor) for base, diff
-                              in zip(lab_begin, lab_diff)),
-               opacity + opacity_diff * (1 - factor))
-
-  def _LabDiff(self, color):
-    begin = utils.RgbToLab(color)
-    return begin, utils.ColorDiff(begin, self.color or begin)
+    colors = lab_begin + numpy.outer(factors, lab_target - lab_begin)
+    opacities = opacity + opacity_diff * factors
+    withreverse = self.options.get('withreverse', False)
+    if self.duration is not None:
+      return TimedFrameTable(
+          colors, opacities, self.duration, withreverse,
+          hold=self.options.get('hold', False),
+          clock=self.options.get('clock', utils.MonotonicTime))
+    return FrameTable(colors, opacities, withreverse=withreverse)
+
+
+class FrameTable(object):
+  """Iterator over the precomputed frames of a started Transition.
+
+  The table holds the starting frame followed by one frame for each step of the
+  transition. Iteration yields (Lab color, opacity) pairs for each step. If the
+  transition is played `withreverse`, the same frames are played back in reverse
+  order afterwards, ending at the starting frame.
+
+  N.B. For the reverse to be the mirror image of the forward transition, the
+  envelope should be symmetric, as the Cosine and Linear envelopes are.
+  """
+  def __init__(self, colors, opacities, withreverse=False):
+    self.colors = colors
+    self.opacities = opacities
+    self.position = 0
+    self.steps = len(colors) - 1
+    self.length = self.steps * (2 if withreverse else 1)
+
+  def __iter__(self):
+    return self
+
+  def __len__(self):
+    """Returns the number of frames remaining in the table."""
+    return self.length - self.position
+
+  def next(self):
+    """Returns the next (color, opacity) frame of the transition."""
+    position = self.position
+    if position >= self.length:
+      raise StopIteration
+    self.position += 1
+    return self._Frame(position)
+
+  def _Frame(self, position):
+    """Returns the (color, opacity) frame for a position in the playback."""
+    if position < self.steps:
+      frame = position + 1
+    else:
+      frame = 2 * self.steps - 1 - position
+    return tuple(self.colors[frame].tolist()), self.opacities[frame].item()
+
+
+class TimedFrameTable(FrameTable):
+  """Iterator over the precomputed frames of a Transition with a duration.
+
+  The frame yielded is determined by the time elapsed since the first frame was
+  requested, rather than by the number of frames requested. This keeps the
+  duration of the transition the same when the update frequency changes, or
+  when updates are dropped. The final frame is always yielded once. If the
+  table is played with `hold`, the final frame is yielded until the duration has
+  passed, rather than once it is reached. Time is read from `clock`.
+  """
+  def __init__(self, colors, opacities, duration, withreverse=False,
+               hold=False, clock=utils.MonotonicTime):
+    super(TimedFrameTable, self).__init__(
+        colors, opacities, withreverse=withreverse)
+    self.begin = None
+    self.clock = clock
+    self.duration = duration / 1000.0 * (2 if withreverse else 1)
+    self.frame_time = duration / 1000.0 / self.steps
+    self.hold = hold
+
+  def __len__(self):
+    """Returns the number of frames remaining in the table."""
+    if self.begin is None:
+      return self.length
+    return self.length - self.position
+
+  def next(self):
+    """Returns the (color, opacity) frame for the current time."""
+    if self.position >= self.length:
+      raise StopIteration
+    now = self.clock()
+    if self.begin is None:
+      self.begin = now
+    if self.frame_time:
+      position = int((now - self.begin) / self.frame_time)
+    else:
+      position = self.length
+    if position >= self.length - 1:
+      position = self.length - 1
+      if self.hold and now - self.begin < self.duration:
+        self.position = position
+      else:
+        self.position = self.length
+    else:
+      self.position = position
+    return self._Frame(position)
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+"""Lightbox performance metrics
+
+This module contains fixed-size histograms and counters that record where the
+Metronome spends its time, and how much work it does. Recording a value is a
+bisection and two additions, cheap enough to leave enabled in production.
+Values are updated without locking; a reader may see a histogram mid-update.
+"""
+__author__ = 'Elmer de Looff <elmer@underdark.nl>'
+__version__ = '1.0'
+
+# Standard modules
+import bisect
+import collections
+
+# Upper bounds of the histogram buckets, for durations and queue depths.
+TIME_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+class Histogram(object):
+  """A histogram of observed values, with fixed bucket bounds.
+
+  Each bucket counts the values up to and including its upper bound, that are
+  greater than the bound of the previous bucket. A final bucket counts all the
+  values greater than the largest bound.
+  """
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.maximum = 0
+    self.total = 0
+
+  def Observe(self, value):
+    """Records a single value in the histogram."""
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.total += value
+    if value > self.maximum:
+      self.maximum = value
+
+  def Info(self):
+    """Returns a dictionary with the bucket counts and summary of values."""
+    return {'buckets': zip(self.bounds + ('+Inf',), self.counts),
+            'count': self.count,
+            'max': self.maximum,
+            'sum': self.total}
+
+  def Exposition(self, name, **labels):
+    """Yields the lines of the histogram in the plain text exposition format.
+
+    Bucket counts in this format are cumulative, as is the convention.
+    """
+    cumulative = 0
+    for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+      cumulative += count
+      yield '%s_bucket%s %d' % (name, _Labels(le=bound, **labels), cumulative)
+    yield '%s_sum%s %r' % (name, _Labels(**labels), self.total)
+    yield '%s_count%s %d' % (name, _Labels(**labels), self.count)
+
+
+class Metrics(object):
+  """Performance metrics of the render loop and serial path of a controller.
+
+  Durations are recorded in seconds: the time taken to compute each frame, to
+  write commands to the device, to wait for the controller lock, and to sleep
+  until the next tick. Output updates are counted as sent or as skipped because
+  they were unchanged. Queue depths are recorded by layer index.
+  """
+  def __init__(self):
+    self.compute_time = Histogram(TIME_BUCKETS)
+    self.lock_wait = Histogram(TIME_BUCKETS)
+    self.sleep_time = Histogram(TIME_BUCKETS)
+    self.write_time = Histogram(TIME_BUCKETS)
+    self.queue_depth = collections.defaultdict(
+        lambda: Histogram(DEPTH_BUCKETS))
+    self.frames_sent = 0
+    self.frames_skipped = 0
+    self.ticks = 0
+
+  def ObserveQueues(self, output):
+    """Records the queue depth of each of the output's layers."""
+    for index, layer in enumerate(output):
+      self.queue_depth[index].Observe(len(layer.queue))
+
+  def Info(self):
+    """Returns a dictionary with all metrics, to be serialized as JSON."""
+    return {'computeTime': self.compute_time.Info(),
+            'framesSent': self.frames_sent,
+            'framesSkipped': self.frames_skipped,
+            'lockWait': self.lock_wait.Info(),
+            'queueDepth': dict((index, histogram.Info()) for index, histogram
+                               in self.queue_depth.items()),
+            'sleepTime': self.sleep_time.Info(),
+            'ticks': self.ticks,
+            'writeTime': self.write_time.Info()}
+
+  def Exposition(self):
+    """Returns all metrics in the plain text exposition format."""
+    return Exposition([({}, self)])
+
+
+class MetricsGroup(object):
+  """The metrics of a number of devices, reported together.
+
+  In the exposition format, the metrics of each device are labeled with the
+  device's index.
+  """
+  def __init__(self, members):
+    self.members = members
+
+  def Info(self):
+    """Returns a dictionary with the metrics of each device."""
+    return {'devices': [member.Info() for member in self.members]}
+
+  def Exposition(self):
+    """Returns the metrics of all devices in the exposition format."""
+    return Exposition([({'device': index}, member)
+                       for index, member in enumerate(self.members)])
+
+
+def Exposition(labeled_metrics):
+  """Returns the given metrics in the plain text exposition format.
+
+  The metrics are given as a list of (labels, Metrics) pairs, where the labels
+  are a dictionary that is added to the labels of each of the metric's values.
+  """
+  lines = []
+  for name, attr in (('compute_seconds', 'compute_time'),
+                     ('lock_wait_seconds', 'lock_wait'),
+                     ('sleep_seconds', 'sleep_time'),
+                     ('write_seconds', 'write_time')):
+    lines.append('# TYPE lightbox_%s histogram' % name)
+    for labels, metrics in labeled_metrics:
+      lines.extend(getattr(metrics, attr).Exposition(
+          'lightbox_' + name, **labels))
+  lines.append('# TYPE lightbox_layer_queue_depth histogram')
+  for labels, metrics in labeled_metrics:
+    for index, histogram in sorted(metrics.queue_depth.items()):
+      lines.extend(histogram.Exposition(
+          'lightbox_layer_queue_depth', layer=index, **labels))
+  for name, attr in (('frames_sent_total', 'frames_sent'),
+                     ('frames_skipped_total', 'frames_skipped'),
+                     ('ticks_total', 'ticks')):
+    lines.append('# TYPE lightbox_%s counter' % name)
+    for labels, metrics in labeled_metrics:
+      lines.append('lightbox_%s%s %d' % (
+          name, _Labels(**labels), getattr(metrics, attr)))
+  return '\n'.join(lines) + '\n'
+
+
+def _Labels(**labels):
+  """Returns the labels for a value in the exposition format, if any."""
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % item for item in sorted(labels.items()))
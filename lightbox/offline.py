@@ -0,0 +1,173 @@
+#!/usr/bin/python
+"""Lightbox offline renderer
+
+This module renders the frames that the Metronome of a controller would send
+for a timeline of API commands, without waiting between ticks. Time is kept by
+a virtual clock that advances one tick period per tick, so transitions with a
+duration play out exactly as they would in real time.
+
+The virtual clock is given to the Recorder's Metronome and to the transitions
+posted to the Recorder, so rendering does not affect the timing of any live
+controllers in the same process.
+
+The resulting Recording holds the colors of all outputs after each tick, and
+which outputs were sent. Recordings can be saved, loaded and compared, to
+check for differences in output between versions of Lightbox. The time taken
+to render is recorded as well, to benchmark the engine without any I/O.
+"""
+__author__ = 'Elmer de Looff <elmer@underdark.nl>'
+__version__ = '1.0'
+
+# Standard modules
+import operator
+import time
+
+# Third-party modules
+import numpy
+
+# Application modules
+from . import controller
+from . import json_api
+
+
+class FrameLog(object):
+  """Collects the frames rendered by a Metronome, in place of a Writer."""
+  def __init__(self, _controller, _size):
+    self.frames = []
+
+  def Info(self):
+    """Returns a dictionary with the number of frames collected."""
+    return {'bufferSize': 0,
+            'bufferedFrames': len(self.frames),
+            'coalescedFrames': 0,
+            'writeErrors': 0}
+
+  def Put(self, frame):
+    """Stores the frame of colors by output index."""
+    self.frames.append(frame)
+
+
+class Recorder(controller.Dummy):
+  """A Dummy controller that renders a timeline of commands as fast as it can.
+
+  The controller is configured like any other, e.g. with `outputs`, `layers`,
+  `frequency`, `frames` and `metronome_cls`. Its Metronome does not run as a
+  thread, but is ticked by `Render`. Nothing is sent to any device. Time is
+  kept by the Recorder's VirtualClock, for its Metronome and for the actions
+  posted to it.
+  """
+  def __init__(self, **kwds):
+    kwds['clock'] = VirtualClock()
+    kwds['metronome_cls'] = _Stepped(kwds.get('metronome_cls',
+                                              controller.Metronome))
+    kwds['writer_cls'] = FrameLog
+    super(Recorder, self).__init__(None, **kwds)
+
+  def Post(self, output_id, action, options):
+    """Posts an action whose transitions keep time by the virtual clock."""
+    super(Recorder, self).Post(
+        output_id, action, dict(options, clock=self.clock))
+
+  def Render(self, timeline, duration):
+    """Renders `duration` seconds of frames, and returns them as a Recording.
+
+    The timeline is a list of (seconds, command) pairs, where the command is a
+    dictionary as it would be sent to the JSON API. Commands are posted to the
+    controller once the virtual clock reaches their time; they are performed
+    before the next tick, as they would be in real time.
+    """
+    events = sorted(timeline, key=operator.itemgetter(0))
+    clock = self.clock
+    clock.now = 0.0
+    colors = []
+    sent = []
+    times = []
+    frames = self.writer.frames
+    begin = time.time()
+    while clock.now < duration:
+      while events and events[0][0] <= clock.now:
+        self.Post(*json_api.ParseCommand(events.pop(0)[1]))
+      del frames[:]
+      self.metronome.Tick()
+      times.append(clock.now)
+      changed = set(index for frame in frames for index in frame)
+      colors.append([output.color for output in self.snapshot])
+      sent.append([index in changed for index in range(len(self))])
+      clock.now += self.metronome._TickPeriod()
+    return Recording(numpy.array(times, dtype=float),
+                     numpy.array(colors, dtype=numpy.uint8),
+                     numpy.array(sent, dtype=bool),
+                     render_time=time.time() - begin)
+
+
+class Recording(object):
+  """The colors of all outputs of a controller, for each tick rendered.
+
+  Attributes:
+    @ times: numpy array of float, shape (ticks,)
+      The virtual time of each tick, in seconds.
+    @ colors: numpy array of uint8, shape (ticks, outputs, 3)
+      The RGB color of each output after each tick.
+    @ sent: numpy array of bool, shape (ticks, outputs)
+      Whether the color of each output was sent to the device on each tick.
+    % render_time: float
+      The real time it took to render the recording, in seconds.
+  """
+  def __init__(self, times, colors, sent, render_time=None):
+    self.times = times
+    self.colors = colors
+    self.sent = sent
+    self.render_time = render_time
+
+  def __len__(self):
+    """Returns the number of ticks in the recording."""
+    return len(self.times)
+
+  @property
+  def ticks_per_second(self):
+    """Returns the number of ticks rendered per second of real time."""
+    if self.render_time:
+      return len(self) / self.render_time
+
+  def Differences(self, other):
+    """Returns the (tick, output) pairs where the two recordings differ.
+
+    Outputs differ when their colors or whether they were sent are different.
+    Recordings of different lengths or numbers of outputs raise ValueError.
+    """
+    if self.colors.shape != other.colors.shape:
+      raise ValueError('Cannot compare recordings of shape %r and %r.' % (
+          self.colors.shape, other.colors.shape))
+    differ = (self.colors != other.colors).any(axis=-1)
+    differ |= self.sent != other.sent
+    return zip(*map(list, numpy.nonzero(differ)))
+
+  @classmethod
+  def Load(cls, path):
+    """Returns the recording stored in the file at `path`."""
+    archive = numpy.load(path)
+    return cls(archive['times'], archive['colors'], archive['sent'])
+
+  def Save(self, path):
+    """Stores the recording in a compressed numpy archive at `path`."""
+    numpy.savez_compressed(
+        path, times=self.times, colors=self.colors, sent=self.sent)
+
+
+class VirtualClock(object):
+  """A clock that only advances when told, in place of `utils.MonotonicTime`."""
+  def __init__(self, now=0.0):
+    self.now = now
+
+  def __call__(self):
+    """Returns the current virtual time."""
+    return self.now
+
+
+def _Stepped(metronome_cls):
+  """Returns a subclass of the Metronome class that does not run as a thread."""
+  def start(_self):
+    """The offline Metronome is ticked by the Recorder, it is not started."""
+  return type('Offline%s' % metronome_cls.__name__,
+              (metronome_cls,), {'start': start})
+
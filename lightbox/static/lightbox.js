@@ -9,6 +9,7 @@
   var apiCommandPath = '/api',
       apiQueryController = '/api',
       apiQueryOutputs = '/api/outputs',
+      apiStreamOutputs = '/api/stream',
       lightbox,
       transitionDialog,
       transitionStepsCount,
@@ -23,8 +24,9 @@
     // Prepare the transition dialog and Lightbox instance
     transitionDialog = $('#picker').detach();
     lightbox = new Lightbox('#preview');
-    lightbox.init();
-    lightbox.automaticUpdates(150);
+    lightbox.init(function() {
+      lightbox.automaticUpdates(150);
+    });
   });
 
   function themeToggle() {
@@ -51,12 +53,33 @@
   }
 
   Lightbox.prototype.automaticUpdates = function(interval) {
+    // Receives output changes from the stream where possible, polls otherwise.
+    var stream, self = this;
+    if (!window.EventSource) {
+      return this.pollUpdates(interval);
+    }
+    stream = new EventSource(apiStreamOutputs);
+    stream.onmessage = function(event) {
+      self.updateOutputs(JSON.parse(event.data));
+    };
+    stream.onerror = function() {
+      if (stream.readyState === EventSource.CLOSED) {
+        self.pollUpdates(interval);
+      }
+    };
+  };
+
+  Lightbox.prototype.pollUpdates = function(interval) {
     this.update();
     setInterval(this.update.bind(this), interval);
   };
 
-  Lightbox.prototype.init = function() {
-    $.getJSON(apiQueryController, this.setupLightbox.bind(this));
+  Lightbox.prototype.init = function(callback) {
+    var self = this;
+    $.getJSON(apiQueryController, function(apiInfo) {
+      self.setupLightbox(apiInfo);
+      callback();
+    });
   };
 
   Lightbox.prototype.setupLightbox = function(apiInfo) {
@@ -92,9 +115,13 @@
   };
 
   Lightbox.prototype.updateOutputs = function(info) {
-    var index;
+    // Updates the outputs present in the info, which may be only some of them.
+    var index, output;
     for (index = 0; index < info.length; index++) {
-      this.outputs[index].update(info[index]);
+      output = this.outputs[info[index].outputNumber];
+      if (output) {
+        output.update(info[index]);
+      }
     }
   };
 
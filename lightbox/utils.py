@@ -3,19 +3,43 @@
 
 This module contains various utility functions to convert between RGB and LAB
 color space, as well as envelope generators and color blenders.
+
+Color space conversions are performed by one of the backends provided by the
+colorspace module. The numpy backend is used by default, the colormath backend
+can be selected as a reference using `SetConversionBackend`. Results of single
+color conversions are kept in bounded LRU caches, see `SetCacheSize`.
 """
 __author__ = 'Elmer de Looff <elmer@underdark.nl>'
 __version__ = '2.3'
 
 # Standard modules
+import collections
+import ctypes
+import ctypes.util
 import math
 import operator
 import random
+import threading
+import time
+
+# Third-party modules
+import numpy
+
+# Application modules
+from . import colorspace
+
+# Backend used for the color space conversions
+_conversion_backend = colorspace.NumpyBackend()
+
+# Conversion cache sizes, and the quantization of Lab components for caching.
+CACHE_SIZE = 4096
+LAB_CACHE_SCALE = 100
+
+# Number of (envelope, steps) factor arrays that are kept, and the largest
+# number of steps for which the factors are cached.
+ENVELOPE_CACHE_SIZE = 256
+ENVELOPE_CACHE_MAX_STEPS = 4096
 
-# Colormath module
-import colormath
-from colormath import color_objects
-from colormath.color_conversions import convert_color
 
 def RandomColor(saturate=False):
   """Generates a random RGB color tuple.
@@ -42,7 +66,8 @@ def ColorDiff(begin, target, factor=1):
 class Blenders(object):
   """A collection of layer blenders.
 
-  These are collected in a class to simplify discovery.
+  These are collected in a class to simplify discovery. Blenders take base and
+  overlay colors as Lab tuples, and return the blended color in Lab.
   """
   @staticmethod
   def Darken(base, overlay, opacity):
@@ -50,13 +75,9 @@ class Blenders(object):
 
     The lightness is the L* component of Lab color.
     """
-    if opacity == 0:
+    if opacity == 0 or overlay[0] >= base[0]:
       return base
-    base = LabColor(RgbToLab(base))
-    l_overlay = RgbToLab(overlay)[0]
-    if l_overlay < base.lab_l:
-      base.lab_l += (l_overlay - base.lab_l) * opacity
-    return LabToRgb(base.get_value_tuple())
+    return (base[0] + (overlay[0] - base[0]) * opacity,) + tuple(base[1:])
 
   @staticmethod
   def Lighten(base, overlay, opacity):
@@ -64,48 +85,107 @@ class Blenders(object):
 
     The lightness is the L* component of Lab color.
     """
-    if opacity == 0:
+    if opacity == 0 or overlay[0] <= base[0]:
       return base
-    base = LabColor(RgbToLab(base))
-    l_overlay = RgbToLab(overlay)[0]
-    if l_overlay > base.lab_l:
-      base.lab_l += (l_overlay - base.lab_l) * opacity
-    return LabToRgb(base.get_value_tuple())
+    return (base[0] + (overlay[0] - base[0]) * opacity,) + tuple(base[1:])
 
   @staticmethod
   def RootSumSquare(base, overlay, opacity):
     """Returns the root of the base squared plus the difference squared.
+
+    N.B. This is calculated on the RGB translation of the given colors.
     """
     if opacity == 0:
       return base
-    diffs = ColorDiff(base, overlay, opacity)
+    base = LabToRgb(base)
+    diffs = ColorDiff(base, LabToRgb(overlay), opacity)
     new_color = [sum(p ** 2 for p in pair) ** .5 for pair in zip(base, diffs)]
     # Ensure that no channel ever goes over value 255, this causes errors.
-    return [min(255, chan) for chan in new_color]
+    return RgbToLab([min(255, chan) for chan in new_color])
 
   @staticmethod
   def RgbAverage(base, overlay, opacity):
     """Returns a tuple where each channel is the average of the given colors.
+
+    N.B. The average is calculated on the RGB translation of the given colors.
     """
     if opacity == 0:
       return base
     elif opacity == 1:
       return overlay
-    return map(sum, zip(base, ColorDiff(base, overlay, opacity)))
+    base = LabToRgb(base)
+    diffs = ColorDiff(base, LabToRgb(overlay), opacity)
+    return RgbToLab(map(sum, zip(base, diffs)))
 
   @staticmethod
   def LabAverage(base, overlay, opacity):
     """Returns a tuple where each channel is the average of the given colors.
-
-    N.B. The average given is the RGB translation of the Lab colors averaged.
     """
     if opacity == 0:
       return base
     elif opacity == 1:
       return overlay
-    base = RgbToLab(base)
-    diffs = ColorDiff(base, RgbToLab(overlay), opacity)
-    return LabToRgb(map(sum, zip(base, diffs)))
+    return map(sum, zip(base, ColorDiff(base, overlay, opacity)))
+
+
+class ArrayBlenders(object):
+  """Vectorized counterparts of the Blenders, operating on arrays of colors.
+
+  Each takes an (N, 3) array of base Lab colors, an (N, 3) array of overlay Lab
+  colors and an (N,) array of opacities, and returns an (N, 3) array of the
+  blended Lab colors. The results match those of the Blenders of the same name.
+  """
+  @staticmethod
+  def Darken(base, overlay, opacity):
+    """Blends each color so the resulting lightness is the same or lower."""
+    return ArrayBlenders._BlendLightness(base, overlay, opacity, numpy.less)
+
+  @staticmethod
+  def Lighten(base, overlay, opacity):
+    """Blends each color so the resulting lightness is the same or higher."""
+    return ArrayBlenders._BlendLightness(base, overlay, opacity, numpy.greater)
+
+  @staticmethod
+  def RootSumSquare(base, overlay, opacity):
+    """Blends to the root of the base squared plus the difference squared."""
+    opacity = opacity[:, numpy.newaxis]
+    rgb_base = LabArrayToRgb(base)
+    diffs = (LabArrayToRgb(overlay) - rgb_base) * opacity
+    blended = numpy.minimum(255, numpy.sqrt(rgb_base ** 2 + diffs ** 2))
+    return numpy.where(opacity == 0, base, RgbArrayToLab(blended))
+
+  @staticmethod
+  def RgbAverage(base, overlay, opacity):
+    """Blends each RGB channel to the opacity-weighted average of the colors."""
+    opacity = opacity[:, numpy.newaxis]
+    rgb_base = LabArrayToRgb(base)
+    blended = rgb_base + (LabArrayToRgb(overlay) - rgb_base) * opacity
+    return numpy.where(opacity == 0, base,
+                       numpy.where(opacity == 1, overlay,
+                                   RgbArrayToLab(blended)))
+
+  @staticmethod
+  def LabAverage(base, overlay, opacity):
+    """Blends each Lab component to the opacity-weighted average."""
+    return base + (overlay - base) * opacity[:, numpy.newaxis]
+
+  @staticmethod
+  def _BlendLightness(base, overlay, opacity, compare):
+    """Moves the L* of the base towards that of the overlay, where compare."""
+    blended = base.copy()
+    l_base, l_overlay = base[:, 0], overlay[:, 0]
+    l_blend = l_base + (l_overlay - l_base) * opacity
+    blended[:, 0] = numpy.where(compare(l_overlay, l_base), l_blend, l_base)
+    return blended
+
+
+# Blenders that can be applied to whole frames at once, by scalar blender.
+ARRAY_BLENDERS = {
+    Blenders.Darken: ArrayBlenders.Darken,
+    Blenders.LabAverage: ArrayBlenders.LabAverage,
+    Blenders.Lighten: ArrayBlenders.Lighten,
+    Blenders.RgbAverage: ArrayBlenders.RgbAverage,
+    Blenders.RootSumSquare: ArrayBlenders.RootSumSquare}
 
 
 # ##############################################################################
@@ -136,6 +216,74 @@ class Envelopes(object):
       yield step / steps
 
 
+def EnvelopeFactors(envelope, steps):
+  """Returns an array of the `steps` multiplication factors of the envelope.
+
+  Factor arrays of up to ENVELOPE_CACHE_MAX_STEPS are cached by envelope and
+  number of steps, and are returned read-only, as the same array is shared by
+  all transitions that use it. Longer arrays are computed for each call.
+  """
+  if steps > ENVELOPE_CACHE_MAX_STEPS:
+    return numpy.fromiter(envelope(steps), dtype=float, count=steps)
+  key = envelope, steps
+  factors = ENVELOPE_CACHE.Get(key)
+  if factors is None:
+    factors = numpy.fromiter(envelope(steps), dtype=float, count=steps)
+    factors.flags.writeable = False
+    ENVELOPE_CACHE.Put(key, factors)
+  return factors
+
+
+def RegisterEnvelope(envelope, name=None):
+  """Registers a user envelope function with the collection of Envelopes.
+
+  The envelope is available under its function name (or the provided `name`)
+  for transitions and the JSON API, and its factors are cached just like those
+  of the built-in envelopes. Returns the envelope, to allow use as decorator.
+  """
+  setattr(Envelopes, name or envelope.__name__, staticmethod(envelope))
+  return envelope
+
+
+# ##############################################################################
+# Monotonic clock
+#
+def _MonotonicClock():
+  """Returns a function that returns the time of a monotonic clock in seconds.
+
+  This uses time.monotonic where available, and otherwise the POSIX function
+  clock_gettime(CLOCK_MONOTONIC). If neither is available, this falls back to
+  time.time, which is subject to changes of the system clock.
+  """
+  if hasattr(time, 'monotonic'):
+    return time.monotonic
+
+  class Timespec(ctypes.Structure):
+    """C struct timespec."""
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+  try:
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+    clock_gettime = librt.clock_gettime
+  except (AttributeError, OSError):
+    return time.time
+  clock_monotonic = 1
+  timespec = Timespec()
+  timespec_ref = ctypes.byref(timespec)
+  lock = threading.Lock()
+
+  def Monotonic():
+    """Returns the time of the monotonic clock, in seconds."""
+    with lock:
+      if clock_gettime(clock_monotonic, timespec_ref):
+        raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+      return timespec.tv_sec + timespec.tv_nsec * 1e-9
+  return Monotonic
+
+
+MonotonicTime = _MonotonicClock()
+
+
 # ##############################################################################
 # Gamma correction table creation
 #
@@ -161,6 +309,82 @@ def GammaCorrectionList(gamma, in_bits=8, out_bits=8):
   return map(int, map(gamma_func, range(2 ** in_bits)))
 
 
+# ##############################################################################
+# Memoization of color conversions
+#
+class LruCache(object):
+  """A bounded mapping that evicts the least recently used entries.
+
+  Lookups and insertions are counted as hits, misses and evictions, which are
+  reported by the `Stats` method. Access is serialized with a lock, as the cache
+  is shared between the Metronome and the threads that create transitions.
+  """
+  def __init__(self, size=CACHE_SIZE):
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.size = size
+    self.hits = self.misses = self.evictions = 0
+
+  def Clear(self):
+    """Removes all entries from the cache, statistics are maintained."""
+    with self.lock:
+      self.entries.clear()
+
+  def Get(self, key):
+    """Returns the cached value for the key, or None if it is not present."""
+    with self.lock:
+      try:
+        value = self.entries.pop(key)
+      except KeyError:
+        self.misses += 1
+        return None
+      self.entries[key] = value
+      self.hits += 1
+      return value
+
+  def Put(self, key, value):
+    """Stores the value for the given key, evicting old entries if needed."""
+    with self.lock:
+      self.entries[key] = value
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def Resize(self, size):
+    """Sets a new maximum size for the cache, evicting entries if needed."""
+    with self.lock:
+      self.size = size
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def Stats(self):
+    """Returns a dictionary with usage statistics of the cache."""
+    lookups = self.hits + self.misses
+    return {'capacity': self.size,
+            'entries': len(self.entries),
+            'evictions': self.evictions,
+            'hits': self.hits,
+            'hitRate': float(self.hits) / lookups if lookups else 0,
+            'misses': self.misses}
+
+
+CONVERSION_CACHES = {'labToRgb': LruCache(), 'rgbToLab': LruCache()}
+ENVELOPE_CACHE = LruCache(ENVELOPE_CACHE_SIZE)
+
+
+def CacheStats():
+  """Returns the usage statistics for each of the conversion caches."""
+  return dict((name, cache.Stats())
+              for name, cache in CONVERSION_CACHES.iteritems())
+
+
+def SetCacheSize(size):
+  """Sets the maximum number of entries for each of the conversion caches."""
+  for cache in CONVERSION_CACHES.itervalues():
+    cache.Resize(size)
+
+
 # ##############################################################################
 # Color translation functions
 #
@@ -179,16 +403,24 @@ def HexToRgb(hex_color):
   return tuple(int(color, 16) for color in colors)
 
 
-def LabColor(lab_color):
-  """Returns the Lab color object with correct illuminant from a value tuple."""
-  return color_objects.LabColor(*lab_color, illuminant='d65')
-
-
 def LabToRgb(lab_color):
   """Returns a tuple of RGB colors for a given tuple of Lab components.
+
+  The Lab components are quantized to 1/LAB_CACHE_SCALE before conversion, so
+  that results for near-identical colors can be served from the cache.
   """
-  rgbcolor = convert_color(LabColor(lab_color), color_objects.sRGBColor)
-  return rgbcolor.get_value_tuple()
+  key = tuple(int(round(comp * LAB_CACHE_SCALE)) for comp in lab_color)
+  rgb_color = CONVERSION_CACHES['labToRgb'].Get(key)
+  if rgb_color is None:
+    lab_color = numpy.array(key, dtype=float) / LAB_CACHE_SCALE
+    rgb_color = tuple(_conversion_backend.LabToRgb(lab_color).tolist())
+    CONVERSION_CACHES['labToRgb'].Put(key, rgb_color)
+  return rgb_color
+
+
+def LabArrayToRgb(lab_colors):
+  """Returns an array of RGB colors for the given array of Lab colors."""
+  return _conversion_backend.LabToRgb(lab_colors)
 
 
 def RgbToLab(rgb_color):
@@ -197,7 +429,58 @@ def RgbToLab(rgb_color):
   The provided RGB color should either be a tuple (red, green, blue) or a hex
   string of 3 or 6 characters (with optional preceeding octothorpe)
   """
-  if isinstance(rgb_color, basestring):
-    rgb_color = HexToRgb(rgb_color)
-  rgb_color = color_objects.sRGBColor(*rgb_color)
-  return convert_color(rgb_color, color_objects.LabColor).get_value_tuple()
+  key = rgb_color if isinstance(rgb_color, basestring) else tuple(rgb_color)
+  lab_color = CONVERSION_CACHES['rgbToLab'].Get(key)
+  if lab_color is None:
+    if isinstance(key, basestring):
+      rgb_color = HexToRgb(key)
+    rgb_color = numpy.array(rgb_color, dtype=float)
+    lab_color = tuple(_conversion_backend.RgbToLab(rgb_color).tolist())
+    CONVERSION_CACHES['rgbToLab'].Put(key, lab_color)
+  return lab_color
+
+
+def RgbArrayToLab(rgb_colors):
+  """Returns an array of Lab colors for the given array of RGB colors."""
+  return _conversion_backend.RgbToLab(rgb_colors)
+
+
+def RgbColorsToLab(rgb_colors):
+  """Returns a list of Lab tuples for the given list of RGB colors.
+
+  Colors are given as RGB tuples or hex strings, as for `RgbToLab`. Those not
+  found in the conversion cache are converted together, in a single pass.
+  """
+  cache = CONVERSION_CACHES['rgbToLab']
+  keys = [color if isinstance(color, basestring) else tuple(color)
+          for color in rgb_colors]
+  lab_colors = map(cache.Get, keys)
+  missing = [index for index, lab_color in enumerate(lab_colors)
+             if lab_color is None]
+  if missing:
+    rgb_array = numpy.array(
+        [HexToRgb(keys[index]) if isinstance(keys[index], basestring)
+         else keys[index] for index in missing], dtype=float)
+    for index, lab_color in zip(missing, RgbArrayToLab(rgb_array).tolist()):
+      lab_colors[index] = tuple(lab_color)
+      cache.Put(keys[index], lab_colors[index])
+  return lab_colors
+
+
+def SetConversionBackend(name, **options):
+  """Selects the color space conversion backend by name and returns it.
+
+  The available backends are listed by `colorspace.Backends()`; 'numpy' is the
+  default, 'colormath' is available as a reference if colormath is installed.
+  The 'lut' backend serves Lab to RGB conversions from a lookup table, and
+  accepts `resolution` and `path` options.
+  """
+  global _conversion_backend
+  backends = colorspace.Backends()
+  if name not in backends:
+    raise ValueError('Conversion backend %r is not available, use one of: %s.'
+                     % (name, ', '.join(sorted(backends))))
+  _conversion_backend = backends[name](**options)
+  for cache in CONVERSION_CACHES.itervalues():
+    cache.Clear()
+  return _conversion_backend
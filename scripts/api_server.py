@@ -3,41 +3,82 @@
 __author__ = 'Elmer de Looff <elmer@underdark.nl>'
 __version__ = '2.0'
 
+# Standard modules
+import threading
+
 # Custom modules
+from lightbox import binary_api
 from lightbox import controller
 from lightbox import json_api
 
 
-def StartLightboxApi(controller_name, port, outputs, quiet):
+def StartLightboxApi(controller_name, port, outputs, quiet, devices=1,
+                     cache=None, threaded=False, binary=None, frames=False):
   """Starts a Lightbox API service.
 
   The provided controller name should be a class of the controller module. An
-  instance of this will be created to use for the JSON API. The server will
-  listen on the provided port number.
+  instance of this will be created to use for the JSON API. If more than one
+  device is requested, these are combined in a MultiController. Otherwise, the
+  device found is remembered in the `cache` file, to speed up later starts.
+  The server will listen on the provided port number. A `threaded` server
+  handles requests concurrently and keeps connections alive. If a `binary`
+  address is given, the binary command server runs alongside the JSON API.
+  With `frames`, controllers that support it write all outputs in one command;
+  other controllers ignore it.
   """
   print 'Initiating controller %r ...' % controller_name
-  ctrl_obj = getattr(controller, controller_name).FirstDevice(outputs=outputs)
+  controller_cls = getattr(controller, controller_name)
+  if devices > 1:
+    ctrl_obj = controller.MultiController.FirstDevice(
+        outputs=outputs, device_cls=controller_cls, devices=devices,
+        frames=frames)
+  else:
+    ctrl_obj = controller_cls.FirstDevice(
+        outputs=outputs, cache=cache, frames=frames)
+  if binary is not None:
+    print 'Starting binary command server on %r ...' % (binary,)
+    binary_server = threading.Thread(
+        target=binary_api.BinaryServer, args=(ctrl_obj, binary))
+    binary_server.daemon = True
+    binary_server.start()
   print 'Starting API server on http://localhost:%d/ ...' % port
-  json_api.ApiServer(ctrl_obj, port=port, quiet=quiet)
+  json_api.ApiServer(ctrl_obj, port=port, quiet=quiet, threaded=threaded)
 
 
 def main():
   """Processes commandline input to setup the API server."""
   import optparse
+  import os
   import sys
   parser = optparse.OptionParser()
+  parser.add_option('-b', '--binary',
+                    help='UDP port or Unix socket path for binary commands.')
   parser.add_option('-c', '--controller', default='NewController',
                     help='Controller class to instantiate.')
+  parser.add_option('--cache', default='~/.lightbox-device.json',
+                    help='File to remember the connected device in.')
+  parser.add_option('-d', '--devices', type='int', default=1,
+                    help='Number of devices to combine as one controller.')
+  parser.add_option('-f', '--frames', action='store_true', default=False,
+                    help='Writes all outputs in one command (new firmware).')
   parser.add_option('-o', '--outputs', type='int', default=5,
-                    help='Number of outputs to use on the hardware.')
+                    help='Number of outputs to use on each device.')
   parser.add_option('-p', '--port', type='int', default=8000,
                     help='Port to run the Lightbox API on.')
   parser.add_option('-q', '--quiet', action='store_true', default=False,
                     help='Disables request logging to stderr.')
+  parser.add_option('-t', '--threaded', action='store_true', default=False,
+                    help='Handles requests concurrently, with keep-alive.')
   options, _arguments = parser.parse_args()
+  binary = options.binary
+  if binary is not None and binary.isdigit():
+    binary = '0.0.0.0', int(binary)
   try:
-    StartLightboxApi(
-        options.controller, options.port, options.outputs, options.quiet)
+    StartLightboxApi(options.controller, options.port, options.outputs,
+                     options.quiet, devices=options.devices,
+                     cache=os.path.expanduser(options.cache),
+                     threaded=options.threaded, binary=binary,
+                     frames=options.frames)
   except controller.ConnectionError:
     sys.exit('ABORT: Could not find a suitable device.')
 
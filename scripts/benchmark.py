@@ -0,0 +1,69 @@
+#!/usr/bin/python
+"""Renders a random timeline of commands offline, and reports the tick rate.
+
+The rendered frames can be saved, and compared against an earlier recording to
+find differences in output between versions of Lightbox. The timeline is
+generated from a fixed seed, so it is the same for every run.
+"""
+__author__ = 'Elmer de Looff <elmer@underdark.nl>'
+__version__ = '1.0'
+
+# Standard modules
+import random
+
+# Custom modules
+from lightbox import offline
+
+
+def Benchmark(outputs, duration, frames, save=None, compare=None):
+  """Renders `duration` seconds of random transitions for all outputs."""
+  box = offline.Recorder(outputs=outputs, frames=frames)
+  recording = box.Render(RandomTimeline(outputs, duration), duration)
+  print 'Rendered %d ticks in %.2fs: %.0f ticks per second.' % (
+      len(recording), recording.render_time, recording.ticks_per_second)
+  if save:
+    recording.Save(save)
+  if compare:
+    differences = recording.Differences(offline.Recording.Load(compare))
+    print '%d outputs differ from the recording in %s.' % (
+        len(differences), compare)
+    for tick, output in differences[:10]:
+      print '  tick %d, output %d' % (tick, output)
+
+
+def RandomTimeline(outputs, duration, seed=0):
+  """Returns a timeline of random fades and blinks, four per second."""
+  rand = random.Random(seed)
+  timeline = []
+  for step in range(int(duration * 4)):
+    timeline.append((step / 4.0, {
+        'action': rand.choice(['blink', 'fade']),
+        'color': [rand.randrange(256) for _channel in range(3)],
+        'duration': rand.randrange(100, 2000),
+        'layer': rand.randrange(2),
+        'opacity': rand.random(),
+        'output': rand.randrange(outputs)}))
+  return timeline
+
+
+def main():
+  """Processes commandline input to setup the benchmark."""
+  import optparse
+  parser = optparse.OptionParser()
+  parser.add_option('-d', '--duration', type='float', default=60,
+                    help='Number of seconds of frames to render.')
+  parser.add_option('-f', '--frames', action='store_true', default=False,
+                    help='Renders in frame mode, all outputs per command.')
+  parser.add_option('-o', '--outputs', type='int', default=5,
+                    help='Number of outputs to render.')
+  parser.add_option('-s', '--save',
+                    help='File to save the recording to.')
+  parser.add_option('-c', '--compare',
+                    help='Earlier recording to compare the output to.')
+  options, _arguments = parser.parse_args()
+  Benchmark(options.outputs, options.duration, options.frames,
+            save=options.save, compare=options.compare)
+
+
+if __name__ == '__main__':
+  main()
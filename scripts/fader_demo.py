@@ -28,11 +28,11 @@ def Demo(controller_name, outputs):
     FadeOutputs(box, '#000')
 
 
-def FadeOutputs(box, color, steps=50):
+def FadeOutputs(box, color, duration=1250):
   """Fades all outputs to the given color and waits for it to complete."""
   for output in box:
-    output.Fade(color=color, steps=steps)
-  time.sleep(steps / (float(box.frequency) / len(box)))
+    output.Fade(color=color, duration=duration)
+  time.sleep(duration / 1000.0)
 
 
 def main():
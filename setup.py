@@ -6,7 +6,7 @@ here = os.path.abspath(os.path.dirname(__file__))
 README = open(os.path.join(here, 'README.md')).read()
 
 requires = [
-  'colormath',
+  'numpy',
   'pyserial',
   'requests',
   'simplejson']
@@ -32,4 +32,5 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=requires,
+    extras_require={'colormath': ['colormath']},
     )
@@ -0,0 +1,37 @@
+#!/usr/bin/python
+"""Tests for the Lightbox outputs, layers and transitions."""
+__author__ = 'Elmer de Looff <elmer@underdark.nl>'
+__version__ = '1.0'
+
+# Standard modules
+import unittest
+
+# Application modules
+from lightbox import light
+
+
+class OutputSkipTest(unittest.TestCase):
+  """Skipping frames of an output, as the Metronome does for dropped ticks."""
+  def setUp(self):
+    self.output = light.Output(layers=1)
+    self.output.Fade(color=(255, 0, 0), opacity=1, steps=10)
+
+  def Mix(self):
+    """Mixes the output as the Metronome does, and returns its color."""
+    if self.output.dirty:
+      color, = light.MixOutputs([self.output])
+      self.output.StoreColor(color)
+    return self.output.color
+
+  def testSkipToEnd(self):
+    """Skipping past the end of a transition mixes its final frame after."""
+    for _tick in range(5):
+      self.Mix()
+    self.output.Skip(10)
+    self.assertTrue(self.output.dirty)
+    self.assertEqual(self.Mix(), (255, 0, 0))
+    self.assertFalse(self.output.dirty)
+
+
+if __name__ == '__main__':
+  unittest.main()